@@ -21,8 +21,14 @@ __status__ = "Production"
 
 
 import argparse
+import gzip
+import hashlib
+import json
 import os.path
+import pipes
+import subprocess
 import sys
+from itertools import islice
 from string import maketrans
 
 # Extending PYTHONPATH for pyflow
@@ -34,6 +40,8 @@ from pyflow import WorkflowRunner
 # Global paths to the binaries
 flash = "/vol/cmg/bin/flash"
 fastqc = "/vol/cmg/bin/fastqc"
+concat_seqs = os.path.join(os.path.dirname(os.path.abspath(__file__)), "concat_seqs.py")
+fastq_qc = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fastq_qc.py")
 
 
 
@@ -49,10 +57,13 @@ def parse_arguments():
 	parser.add_argument("--flash-max-overlap", dest='flash_max', help="Maximal overlap length. Default: %iBP" % (65), default=65, type=int, required=False)
 	
 	parser.add_argument("--fastqc-path", dest='fastqc', help="Path to fastqc binary to use. Default: %s" % (fastqc), default=fastqc, required=False, type=str)
+	parser.add_argument("--qc-engine", dest='qc_engine', help="QC of the merged reads: FastQC, the built-in fastq_qc.py (per-position quality, length distribution, N content and merge rate in qc/) or both. Default: %s" % ('both'), choices=['fastqc', 'builtin', 'both'], default='both', required=False)
 	
 	parser.add_argument("--qiime-steps", dest='qiime_steps', help="Step 4 realted settings for OTU clustering. Default: %s" % ('suppress_step4'), choices=['with_step4', 'suppress_step4', 'both'], default='suppress_step4', required=False)
 	parser.add_argument("--qiime-settings", dest='qiime_settings', help="Path to qiime parameter file (optional).", required=False, default=None, type=str)
 	parser.add_argument("--qiime-metadata", dest='qiime_metadata', help="Tab-separated metadata for all samples with QIIME-compatible normalized SampleIDs. 'a-z', 'A-Z' and '.' are allowed characters. Sample names as found in the input directory as subdirectories are normalized through replacing the following characters with a '.': _-+%%<BLANK WHITESPACE>;:,/ A header with speaking category names is required, starting with '#SampleID'. Allowed characters for the header are: 'a-z', 'A-Z', '0-9' and '_'. Example header: '#SampleID\\tCondition\\tMedication'", required=False, default=None, type=str)
+	parser.add_argument("--scatter-demultiplexing", dest='scatter', help="Quality filter each sample in a split_libraries_fastq.py task of its own, started as soon as its reads are merged, and concatenate the results into one seqs.fna afterwards instead of one run over all samples.", required=False, default=False, action='store_true')
+	parser.add_argument("--no-step-cache", dest='step_cache', help="Recompute all samples. By default merging, QC and quality filtering of a sample are skipped if its inputs, parameters and binaries are unchanged since their last successful run in the same output directory.", required=False, default=True, action='store_false')
 	parser.add_argument("--new-cluster", dest='new_cluster', help="Use the new cluster engine (OGE)", required=False, default=False, action='store_true')
 	
 	
@@ -83,9 +94,157 @@ def parse_arguments():
 
 
 
+def file_identity(path):
+	"""
+	Path, size and mtime of a file, or just its path if it does not exist.
+	"""
+	path = os.path.abspath(path)
+	if not os.path.exists(path):
+		return [path]
+	stat = os.stat(path)
+	return [path, stat.st_size, int(stat.st_mtime)]
+
+
+
+def binary_version(path):
+	"""
+	First line printed by <binary> --version plus the identity of the binary itself.
+	"""
+	try:
+		version = subprocess.Popen([path, "--version"], stdout=subprocess.PIPE, stderr=subprocess.STDOUT).communicate()[0]
+	except OSError:
+		version = ""
+	return [version.strip().split("\n")[0]] + file_identity(path)
+
+
+
+class StepCache(object):
+	"""
+	Remembers the key of every task that finished successfully in <output_dir>/.stepcache/<label>.key. A key is
+	a hash of the task's command, the identity of its inputs or the keys of the tasks it depends on, and the
+	versions of the binaries it runs. Tasks whose key and outputs are still there need not run again.
+	"""
+
+	def __init__(self, output_dir, enabled=True):
+		self.cache_dir = os.path.join(output_dir, ".stepcache")
+		self.enabled = enabled
+		if not os.path.exists(self.cache_dir):
+			os.mkdir(self.cache_dir)
+
+	def key(self, *parts):
+		return hashlib.sha1(json.dumps(parts, sort_keys=True)).hexdigest()
+
+	def path(self, label):
+		return os.path.join(self.cache_dir, "%s.key" % (label))
+
+	def is_cached(self, label, key, outputs):
+		if not self.enabled or not os.path.exists(self.path(label)):
+			return False
+		for output in outputs:
+			if not os.path.exists(output) or not os.path.getsize(output):
+				return False
+		inFile = open(self.path(label))
+		cached = inFile.read().strip()
+		inFile.close()
+		return cached == key
+
+	def command(self, label, key, cmd, outputs):
+		"""
+		Wraps cmd, so that the key is stored only if it succeeded and left non-empty outputs. The exit status stays
+		the one of cmd, empty outputs (e.g. no read merged) are no failure, they are just not cached.
+		"""
+		checks = ["test -s %s" % (output) for output in outputs] or ["true"]
+		return "rm -f %s && ( %s )" % (self.path(label), cmd)\
+			+ " && { %s && echo %s > %s || true; }" % (" && ".join(checks), key, self.path(label))
+
+
+
+class ResourceModel(object):
+	"""
+	Sizes cores and memory of FLASH, clustering and diversity tasks by the read count of the samples. Cores are
+	chosen so that a task finishes within TARGET_SECONDS at the reads per second and core measured for its step.
+	Every sized task that succeeds appends its reads, cores and seconds to <output_dir>/runtimes.tsv, and the rates
+	of the most recent runs replace the defaults below once there are any.
+	"""
+
+	# Wall time a task should not exceed if more cores can help
+	TARGET_SECONDS = 900
+	# Most recent runs of a step the calibration is based on
+	RECENT = 200
+	# Records read from the start of a FASTQ to estimate its read count
+	SAMPLE_READS = 10000
+	# Reads per second and core until runs were recorded
+	DEFAULT_RATES = {"flash": 20000, "clustering": 500, "alphadiversity": 2000, "betadiversity": 5000}
+	# memMb = base + per million reads, capped at maximum
+	MEMORY = {"flash": (512, 128, 8192), "clustering": (4096, 2048, 65536), "alphadiversity": (1024, 256, 16384), "betadiversity": (1024, 256, 16384)}
+
+	def __init__(self, output_dir, max_cores):
+		self.path = os.path.join(output_dir, "runtimes.tsv")
+		self.max_cores = max_cores
+		self.rates = self.calibrate()
+
+	def calibrate(self):
+		"""
+		Returns the reads per second and core of every step in recent runs.
+		"""
+		runs = {}
+		if os.path.exists(self.path):
+			inFile = open(self.path)
+			for line in inFile:
+				line = line.rstrip("\n").split("\t")
+				try:
+					step, reads, cores, seconds = line[0], int(line[2]), int(line[3]), int(line[4])
+				except (IndexError, ValueError):
+					# Truncated or garbled line
+					continue
+				if len(line) == 5 and reads > 0 and cores > 0 and seconds > 0:
+					runs.setdefault(step, []).append(reads/float(cores*seconds))
+			inFile.close()
+		rates = dict(self.DEFAULT_RATES)
+		for step in runs:
+			recent = sorted(runs[step][-self.RECENT:])
+			rates[step] = recent[len(recent)/2]
+		return rates
+
+	def reads(self, path):
+		"""
+		Estimates the reads of a .fastq(.gz) from the compressed bytes its first SAMPLE_READS records take.
+		"""
+		if not os.path.exists(path):
+			return 0
+		rawFile = open(path, "rb")
+		inFile = gzip.GzipFile(fileobj=rawFile) if path.endswith(".gz") else rawFile
+		lines = 0
+		for line in islice(inFile, 4*self.SAMPLE_READS):
+			lines += 1
+		consumed = rawFile.tell()
+		inFile.close()
+		rawFile.close()
+		if lines < 4*self.SAMPLE_READS or not consumed:
+			return lines/4
+		return int(lines/4 * os.path.getsize(path) / float(consumed))
+
+	def cores(self, step, reads, max_cores=None):
+		needed = reads / (self.rates[step] * self.TARGET_SECONDS)
+		return int(min(max(1, needed+1), max_cores or self.max_cores))
+
+	def memory(self, step, reads):
+		base, per_million, maximum = self.MEMORY[step]
+		return int(min(base + per_million*reads/1000000.0, maximum))
+
+	def timed(self, step, label, reads, cores, cmd):
+		"""
+		Wraps cmd, so that its runtime is recorded if it succeeded. Failed or killed runs would skew the rates.
+		"""
+		# Step and label are printf arguments, never part of its format, sample names may contain a '%'
+		return "start=$(date +%%s); ( %s ); rc=$?; if [ $rc -eq 0 ]; then printf '%%s\\t%%s\\t%%s\\t%%s\\t%%s\\n' %s %s %i %i $(( $(date +%%s) - start )) >> %s; fi; exit $rc"\
+			% (cmd, pipes.quote(step), pipes.quote(label), reads, cores, self.path)
+
+
+
 class RRNa16sWorkflow(WorkflowRunner):
 	
-	def __init__(self, stop_at, output_dir, samples, flash, flash_th, flash_min, flash_max, fastqc, qiime_steps, qiime_settings, qiime_metadata, nCores):
+	def __init__(self, stop_at, output_dir, samples, flash, flash_th, flash_min, flash_max, fastqc, qc_engine, qiime_steps, qiime_settings, qiime_metadata, scatter, step_cache, nCores):
 		self.stop_at = stop_at
 		self.output_dir = output_dir
 		self.samples = samples
@@ -94,15 +253,35 @@ class RRNa16sWorkflow(WorkflowRunner):
 		self.flash_min = flash_min
 		self.flash_max = flash_max
 		self.fastqc = fastqc
+		self.qc_engine = qc_engine
 		self.qiime_steps = qiime_steps
 		self.qiime_settings = qiime_settings
 		self.qiime_metadata = qiime_metadata
+		self.scatter = scatter
+		self.cache = StepCache(output_dir, step_cache)
+		self.resources = ResourceModel(output_dir, nCores)
 		self.nCores = nCores
 	
+	def addCachedTask(self, label, key, command, outputs, **kwargs):
+		"""
+		Adds the task, or a no-op task with the same label and dependencies if it is cached.
+		"""
+		if self.cache.is_cached(label, key, outputs):
+			print("Cached: %s" % (label))
+			return self.addTask(label=label, dependencies=kwargs.get("dependencies"))
+		return self.addTask(label=label, command=self.cache.command(label, key, command, outputs), **kwargs)
+
+	def mkdir(self, name):
+		if not os.path.exists(os.path.join(self.output_dir, name)):
+			os.mkdir(os.path.join(self.output_dir, name))
+
 	def workflow(self):
-		os.mkdir(os.path.join(self.output_dir, "flash"))
+		self.mkdir("flash")
 		print("KEYS: %s" % (", ".join(self.samples.keys())))
 		flash_tasks = []
+		flash_keys = {}
+		flash_version = binary_version(self.flash)
+		reads = {}
 		for key in self.samples.keys():
 			print("TaskID: %s for Inputs %s and %s" % (key, self.samples[key][0], self.samples[key][1]))
 			flash_tasks.append(key)
@@ -114,18 +293,58 @@ class RRNa16sWorkflow(WorkflowRunner):
 				+ " -M %i" % (self.flash_max)\
 				+ " -d %s" % (os.path.join(self.output_dir, "flash"))\
 				+ " -o %s" % (key)\
-				+ " -x %f" % (self.flash_th)\
+				+ " -x %f" % (self.flash_th)
+			flash_keys[key] = self.cache.key(cmd, file_identity(self.samples[key][0]), file_identity(self.samples[key][1]), flash_version)
+
+			# Read pairs decide the threads, which do not change the result and are no part of the cache key
+			reads[key] = self.resources.reads(self.samples[key][0])
+			nCores = self.resources.cores("flash", reads[key])
+			cmd += " -t %i" % (nCores)\
 				+ " 2>&1 | tee %s" % (os.path.join(self.output_dir, "flash", key+".log") )
 			
-			self.addTask(label=key, command=cmd, nCores=1, memMb=8192)
+			self.addCachedTask(key, flash_keys[key], self.resources.timed("flash", key, reads[key], nCores, cmd), [os.path.join(self.output_dir, "flash", "%s.extendedFrags.fastq" % (key))], nCores=nCores, memMb=self.resources.memory("flash", reads[key]))
 
 # Perform QC
-		if self.stop_at > 0:
-			os.mkdir(os.path.join(self.output_dir, "fastqc"))
-			cmd = "%s" % (self.fastqc)\
-				+ " -o %s" % (os.path.join(self.output_dir, "fastqc"))\
-				+ " %s" % (os.path.join(self.output_dir, "flash", "*.extendedFrags.fastq"))
-			self.addTask(label="fastqc", command=cmd, isForceLocal=True, dependencies=flash_tasks)
+		if self.stop_at > 0 and self.qc_engine != 'builtin':
+			self.mkdir("fastqc")
+			fastqc_version = binary_version(self.fastqc)
+			# One QC task per sample, started as soon as its own reads are merged
+			fastqc_tasks = []
+			summaries = []
+			for key in self.samples.keys():
+				fastqc_tasks.append("fastqc_"+key)
+				summaries.append(os.path.join(self.output_dir, "fastqc", "%s.extendedFrags_fastqc" % (key), "summary.txt"))
+				cmd = "%s" % (self.fastqc)\
+					+ " -o %s" % (os.path.join(self.output_dir, "fastqc"))\
+					+ " -t 1"\
+					+ " --extract"\
+					+ " %s" % (os.path.join(self.output_dir, "flash", "%s.extendedFrags.fastq" % (key)))
+				self.addCachedTask("fastqc_"+key, self.cache.key(cmd, flash_keys[key], fastqc_version), cmd, summaries[-1:], dependencies=key, nCores=1, memMb=1024)
+
+			# Collect the PASS/WARN/FAIL lines of all samples into one table
+			cmd = "cat %s" % (" ".join(summaries))\
+				+ " > %s" % (os.path.join(self.output_dir, "fastqc", "summary.txt"))
+			self.addTask(label="fastqc", command=cmd, isForceLocal=True, dependencies=fastqc_tasks)
+
+		if self.stop_at > 0 and self.qc_engine != 'fastqc':
+			self.mkdir("qc")
+			qc_tasks = []
+			summaries = []
+			for key in self.samples.keys():
+				qc_tasks.append("fastq_qc_"+key)
+				summaries.append(os.path.join(self.output_dir, "qc", "%s.json" % (key)))
+				cmd = "%s %s" % (sys.executable, fastq_qc)\
+					+ " -s %s" % (key)\
+					+ " -i %s" % (os.path.join(self.output_dir, "flash", "%s.extendedFrags.fastq" % (key)))\
+					+ " -n %s" % (os.path.join(self.output_dir, "flash", "%s.notCombined_1.fastq" % (key)))\
+					+ " -o %s" % (os.path.join(self.output_dir, "qc", "%s.json" % (key)))
+				self.addCachedTask("fastq_qc_"+key, self.cache.key(cmd, flash_keys[key], file_identity(fastq_qc)), cmd, summaries[-1:], dependencies=key, nCores=1, memMb=1024)
+
+			# One line per sample with reads, merge rate, mean length, quality and N content
+			cmd = "%s %s" % (sys.executable, fastq_qc)\
+				+ " -o %s" % (os.path.join(self.output_dir, "qc", "summary.tsv"))\
+				+ " --combine %s" % (" ".join(summaries))
+			self.addTask(label="fastq_qc", command=cmd, isForceLocal=True, dependencies=qc_tasks)
 
 # Perform demultiplexing
 
@@ -133,7 +352,7 @@ class RRNa16sWorkflow(WorkflowRunner):
 		tr_table = maketrans("_-+% ;:,/",".........")
 
 		if self.stop_at > 1:
-			os.mkdir(os.path.join(self.output_dir, "qiime"))
+			self.mkdir("qiime")
 			
 			metadata_ = {}
 			metadata_header = None
@@ -173,16 +392,39 @@ class RRNa16sWorkflow(WorkflowRunner):
 				keys_.append(key.translate(tr_table))
 				files_.append(os.path.join(self.output_dir, "flash", "%s.extendedFrags.fastq" % (key)))
 			
-			cmd = cmd_qiime_base\
-				+ "split_libraries_fastq.py"\
-				+ " -i %s" % (",".join(files_))\
-				+ " --sample_id %s" % (",".join(keys_))\
-				+ " -o %s" % (os.path.join(self.output_dir, "qiime", "splitted_library"))\
-				+ " -q 19"\
-				+ " --barcode_type 'not-barcoded'"\
-				+ " -m %s" % (os.path.join(self.output_dir, "qiime", "combined_mapping.txt"))
-			
-			self.addTask(label="split_qiime", command=cmd, dependencies=flash_tasks, env={"PATH": "/vol/qiime-1.9/anaconda-2.1x64/bin:/usr/bin:$PATH"}, isForceLocal=True)
+			if self.scatter:
+				# Scatter: one filtering task per sample, each waiting only for its own merge
+				split_tasks = []
+				seqs_ = []
+				for key in self.samples.keys():
+					split_tasks.append("split_qiime_"+key)
+					seqs_.append(os.path.join(self.output_dir, "qiime", "splitted_samples", key, "seqs.fna"))
+					cmd = cmd_qiime_base\
+						+ "split_libraries_fastq.py"\
+						+ " -i %s" % (os.path.join(self.output_dir, "flash", "%s.extendedFrags.fastq" % (key)))\
+						+ " --sample_id %s" % (key.translate(tr_table))\
+						+ " -o %s" % (os.path.join(self.output_dir, "qiime", "splitted_samples", key))\
+						+ " -q 19"\
+						+ " --barcode_type 'not-barcoded'"\
+						+ " -m %s" % (os.path.join(self.output_dir, "qiime", "combined_mapping.txt"))
+					self.addCachedTask("split_qiime_"+key, self.cache.key(cmd, flash_keys[key]), cmd, seqs_[-1:], dependencies=key, env={"PATH": "/vol/qiime-1.9/anaconda-2.1x64/bin:/usr/bin:$PATH"}, nCores=1, memMb=2048)
+
+				# Gather: renumber the reads in sample order, as the single run would have
+				cmd = "%s %s" % (sys.executable, concat_seqs)\
+					+ " -o %s" % (os.path.join(self.output_dir, "qiime", "splitted_library", "seqs.fna"))\
+					+ " %s" % (" ".join(seqs_))
+				self.addTask(label="split_qiime", command=cmd, dependencies=split_tasks, isForceLocal=True)
+			else:
+				cmd = cmd_qiime_base\
+					+ "split_libraries_fastq.py"\
+					+ " -i %s" % (",".join(files_))\
+					+ " --sample_id %s" % (",".join(keys_))\
+					+ " -o %s" % (os.path.join(self.output_dir, "qiime", "splitted_library"))\
+					+ " -q 19"\
+					+ " --barcode_type 'not-barcoded'"\
+					+ " -m %s" % (os.path.join(self.output_dir, "qiime", "combined_mapping.txt"))
+
+				self.addCachedTask("split_qiime", self.cache.key(cmd, [flash_keys[sample] for sample in self.samples.keys()]), cmd, [os.path.join(self.output_dir, "qiime", "splitted_library", "seqs.fna")], dependencies=flash_tasks, env={"PATH": "/vol/qiime-1.9/anaconda-2.1x64/bin:/usr/bin:$PATH"}, isForceLocal=True)
 	
 
 # Perform OTU clustering and taxonomical classification
@@ -194,10 +436,11 @@ class RRNa16sWorkflow(WorkflowRunner):
 			
 			# 'with_step4', 'suppress_step4', 'both'
 			
-			nCores = self.nCores
-			memUsage = 4096
+			total_reads = sum(reads.values())
+			nCores = self.resources.cores("clustering", total_reads)
+			memUsage = self.resources.memory("clustering", total_reads)
 			if self.qiime_steps == 'both':
-				nCores = self.nCores/2
+				nCores = self.resources.cores("clustering", total_reads, self.nCores/2)
 				memUsage = 2*memUsage
 			
 			cmd = cmd_qiime_base\
@@ -206,7 +449,8 @@ class RRNa16sWorkflow(WorkflowRunner):
 				+ " -a"\
 				+ " -O %i" % (nCores)\
 				+ " -m usearch61"\
-				+ " -v"
+				+ " -v"\
+				+ " -f"
 			
 			if self.qiime_settings:
 				cmd += " -p %s" % (self.qiime_settings)
@@ -219,7 +463,7 @@ class RRNa16sWorkflow(WorkflowRunner):
 					qiime_output_dirs.append("open_ref_otus_tax_w4")
 					cmd_ = cmd\
 						+ " -o %s" % (os.path.join(self.output_dir, "qiime", "open_ref_otus_tax_w4"))
-					self.addTask(label="openref_qiime_tax_w4", command=cmd_, dependencies="split_qiime", env={"PATH": "/vol/qiime-1.9/anaconda-2.1x64/bin:/usr/bin:/bin:/usr(local/bin:$PATH"}, nCores=nCores, memMb=memUsage)
+					self.addTask(label="openref_qiime_tax_w4", command=self.resources.timed("clustering", "openref_qiime_tax_w4", total_reads, nCores, cmd_), dependencies="split_qiime", env={"PATH": "/vol/qiime-1.9/anaconda-2.1x64/bin:/usr/bin:/bin:/usr(local/bin:$PATH"}, nCores=nCores, memMb=memUsage)
 					
 					
 					cmd_add = cmd_qiime_base\
@@ -235,7 +479,7 @@ class RRNa16sWorkflow(WorkflowRunner):
 					cmd_ = cmd\
 						+ " -o %s" % (os.path.join(self.output_dir, "qiime", "open_ref_otus_w4"))\
 						+ " --suppress_taxonomy_assignment"
-					self.addTask(label="openref_qiime_w4", command=cmd_, dependencies="split_qiime", env={"PATH": "/vol/qiime-1.9/anaconda-2.1x64/bin:/usr/bin:/bin:/usr(local/bin:$PATH"}, nCores=nCores, memMb=memUsage)
+					self.addTask(label="openref_qiime_w4", command=self.resources.timed("clustering", "openref_qiime_w4", total_reads, nCores, cmd_), dependencies="split_qiime", env={"PATH": "/vol/qiime-1.9/anaconda-2.1x64/bin:/usr/bin:/bin:/usr(local/bin:$PATH"}, nCores=nCores, memMb=memUsage)
 
 
 			if self.qiime_steps == 'suppress_step4' or self.qiime_steps == 'both':
@@ -246,7 +490,7 @@ class RRNa16sWorkflow(WorkflowRunner):
 						+ " -o %s" % (os.path.join(self.output_dir, "qiime", "open_ref_otus_tax_no4"))\
 						+ " --suppress_step4"
 
-					self.addTask(label="openref_qiime_tax_no4", command=cmd_, dependencies="split_qiime", env={"PATH": "/bin:/usr/local/bin:/usr/bin:/vol/qiime-1.9/anaconda-2.1x64/bin:$PATH"}, nCores=nCores, memMb=memUsage)
+					self.addTask(label="openref_qiime_tax_no4", command=self.resources.timed("clustering", "openref_qiime_tax_no4", total_reads, nCores, cmd_), dependencies="split_qiime", env={"PATH": "/bin:/usr/local/bin:/usr/bin:/vol/qiime-1.9/anaconda-2.1x64/bin:$PATH"}, nCores=nCores, memMb=memUsage)
 			
 					cmd_add = cmd_qiime_base\
 						+ "biom add-metadata"\
@@ -265,13 +509,13 @@ class RRNa16sWorkflow(WorkflowRunner):
 						+ " --suppress_taxonomy_assignment"
 					
 					
-					self.addTask(label="openref_qiime_no4", command=cmd_, dependencies="split_qiime", env={"PATH": "/bin:/usr/local/bin:/usr/bin:/vol/qiime-1.9/anaconda-2.1x64/bin:$PATH"}, nCores=nCores, memMb=memUsage)
+					self.addTask(label="openref_qiime_no4", command=self.resources.timed("clustering", "openref_qiime_no4", total_reads, nCores, cmd_), dependencies="split_qiime", env={"PATH": "/bin:/usr/local/bin:/usr/bin:/vol/qiime-1.9/anaconda-2.1x64/bin:$PATH"}, nCores=nCores, memMb=memUsage)
 
 # Compute alpha diversity measures and plots
 		if self.stop_at > 4:
-			nCores = self.nCores
+			nCores = self.resources.cores("alphadiversity", total_reads)
 			if self.qiime_steps == 'both':
-				nCores = self.nCores/2
+				nCores = self.resources.cores("alphadiversity", total_reads, self.nCores/2)
 			
 			for entry in qiime_output_dirs:
 				cmd = cmd_qiime_base\
@@ -282,14 +526,15 @@ class RRNa16sWorkflow(WorkflowRunner):
 					+ " -m %s" % (os.path.join(self.output_dir, "qiime", "combined_mapping.txt"))\
 					+ " -a"\
 					+ " -O %i" % (nCores)\
-					+ " -p %s" % (os.path.join(self.output_dir, "qiime", "alpha_parameters.txt"))
-				self.addTask(label="alphadiversity_"+entry, command=cmd, dependencies=qiime_tasks, env={"PATH": "/bin:/usr/local/bin:/usr/bin:/vol/qiime-1.9/anaconda-2.1x64/bin:$PATH"}, memMb=1024, nCores=nCores)
+					+ " -p %s" % (os.path.join(self.output_dir, "qiime", "alpha_parameters.txt"))\
+					+ " -f"
+				self.addTask(label="alphadiversity_"+entry, command=self.resources.timed("alphadiversity", entry, total_reads, nCores, cmd), dependencies=qiime_tasks, env={"PATH": "/bin:/usr/local/bin:/usr/bin:/vol/qiime-1.9/anaconda-2.1x64/bin:$PATH"}, memMb=self.resources.memory("alphadiversity", total_reads), nCores=nCores)
 
 # Compute beta diversity measures and plots
 		if self.stop_at > 5:
-			nCores = self.nCores
+			nCores = self.resources.cores("betadiversity", total_reads)
 			if self.qiime_steps == 'both':
-				nCores = self.nCores/2
+				nCores = self.resources.cores("betadiversity", total_reads, self.nCores/2)
 			
 			for entry in qiime_output_dirs:
 				cmd = cmd_qiime_base\
@@ -299,8 +544,9 @@ class RRNa16sWorkflow(WorkflowRunner):
 					+ " -o %s" % (os.path.join(self.output_dir, "qiime", entry, "beta_diversity"))\
 					+ " -t %s" % (os.path.join(self.output_dir, "qiime", entry, "rep_set.tre"))\
 					+ " -a"\
-					+ " -O %i" % (nCores)
-				self.addTask(label="betadiversity_"+entry, command=cmd, dependencies=qiime_tasks, env={"PATH": "/bin:/usr/local/bin:/usr/bin:/vol/qiime-1.9/anaconda-2.1x64/bin:$PATH"}, memMb=1024, nCores=nCores)
+					+ " -O %i" % (nCores)\
+					+ " -f"
+				self.addTask(label="betadiversity_"+entry, command=self.resources.timed("betadiversity", entry, total_reads, nCores, cmd), dependencies=qiime_tasks, env={"PATH": "/bin:/usr/local/bin:/usr/bin:/vol/qiime-1.9/anaconda-2.1x64/bin:$PATH"}, memMb=self.resources.memory("betadiversity", total_reads), nCores=nCores)
 
 # Generate taxonomical plots
 		if self.stop_at > 6:
@@ -309,7 +555,8 @@ class RRNa16sWorkflow(WorkflowRunner):
 					+ "summarize_taxa_through_plots.py"\
 					+ " -i %s" % (os.path.join(self.output_dir, "qiime", entry, "otu_table_mc2_w_tax_no_pynast_failures.biom"))\
 					+ " -o %s" % (os.path.join(self.output_dir, "qiime", entry, "taxa_plots"))\
-					+ " -m %s" % (os.path.join(self.output_dir, "qiime", "combined_mapping.txt"))
+					+ " -m %s" % (os.path.join(self.output_dir, "qiime", "combined_mapping.txt"))\
+					+ " -f"
 				
 				if self.qiime_settings:
 					cmd += " -p %s" % (self.qiime_settings)
@@ -378,7 +625,7 @@ def main():
 			samplename = "_".join(files[i*2].split(".")[0].split("_")[:-1])
 			samples[samplename] = [os.path.join(args.input_dir, files[i*2]), os.path.join(args.input_dir, files[i*2+1])]
 
-	wflow = RRNa16sWorkflow(args.stop_at, args.output_dir, samples, args.flash, args.flash_th, args.flash_min, args.flash_max, args.fastqc, args.qiime_steps, args.qiime_settings, args.qiime_metadata,  args.nCores)
+	wflow = RRNa16sWorkflow(args.stop_at, args.output_dir, samples, args.flash, args.flash_th, args.flash_min, args.flash_max, args.fastqc, args.qc_engine, args.qiime_steps, args.qiime_settings, args.qiime_metadata, args.scatter, args.step_cache, args.nCores)
 	if args.new_cluster:
 		retval = wflow.run(mode="sge", nCores=args.nCores, memMb="unlimited", isDryRun=args.dry_run)
 	else:
@@ -0,0 +1,342 @@
+#!/usr/bin/env python2.7
+# coding=utf-8
+
+"""
+	Date:   18/10/2026
+	Usage:  For usage instructions run with option --help
+	Author: Madis Rumming <mrumming@cebitec.uni-bielefeld.de>
+"""
+
+__author__  = "Madis Rumming <mrumming@cebitec.uni-bielefeld.de>"
+__copyright__ = "Copyright 2016, Computational Metagenomics, Faculty of Technology, Bielefeld University"
+
+__version__ = "1.2.a"
+__maintainer__ = "Madis Rumming"
+__email__ = "mrumming@cebitec.uni-bielefeld.de"
+__status__ = "Production"
+
+
+
+
+import argparse
+import os.path
+import sys
+import json
+import resource
+import shutil
+import tempfile
+import threading
+import time
+
+import genomeportal_pyflow as gp
+import mock_jgi_portal as mock
+
+# Offline benchmark of the genome portal downloader against mock_jgi_portal.py. Runs the lanes of the XML phase
+# (GatherXMLWorkflow), the download phase (GatherDownload) and the shrinking step (post_process_tar) one after
+# the other without pyflow scheduling, and reports throughput, peak RSS and peak tmp disk use of each.
+
+
+def dir_size(path):
+    size = 0
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            try:
+                size += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                # Moved or removed while walking
+                pass
+    return size
+
+
+def proc_rss(pid):
+    """
+    Resident set size of a process in bytes, 0 if it is gone.
+    """
+    try:
+        inFile = open("/proc/%i/status" % (pid))
+    except IOError:
+        return 0
+    try:
+        for line in inFile:
+            if line.startswith("VmRSS:"):
+                # VmRSS:    1234 kB
+                return int(line.split()[1]) * 1024
+    finally:
+        inFile.close()
+    return 0
+
+
+def descendants(pid):
+    """
+    PIDs of all processes below pid, e.g. tar and pigz started by a lane.
+    """
+    children = {}
+    for name in os.listdir("/proc"):
+        if not name.isdigit():
+            continue
+        try:
+            inFile = open("/proc/%s/stat" % (name))
+            stat = inFile.read()
+            inFile.close()
+        except IOError:
+            continue
+        # The command name in parentheses may contain blanks, the parent PID is the second field after it
+        ppid = int(stat[stat.rindex(")") + 2:].split()[1])
+        children.setdefault(ppid, []).append(int(name))
+    found = []
+    todo = [pid]
+    while todo:
+        for child in children.get(todo.pop(), []):
+            found.append(child)
+            todo.append(child)
+    return found
+
+
+class DiskSampler(threading.Thread):
+    """
+    Polls the size of a directory and the memory of this process and its children, and keeps their peaks. Unlike
+    ru_maxrss, which only grows over the lifetime of the process, these are the peaks of one phase.
+    """
+
+    # Seconds between two samples
+    INTERVAL = 0.2
+
+    def __init__(self, path):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.path = path
+        self.peak = 0
+        self.rss_peak = 0
+        self.rss_peak_children = 0
+        self.stopped = threading.Event()
+
+    def sample(self):
+        self.peak = max(self.peak, dir_size(self.path))
+        self.rss_peak = max(self.rss_peak, proc_rss(os.getpid()))
+        self.rss_peak_children = max(self.rss_peak_children,
+                                     sum(proc_rss(pid) for pid in descendants(os.getpid())))
+
+    def run(self):
+        while not self.stopped.is_set():
+            self.sample()
+            self.stopped.wait(self.INTERVAL)
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+        self.sample()
+        return self.peak
+
+
+def run_lanes(wflows):
+    """
+    Runs the workflow() of every lane in a thread of its own, as pyflow does for workflow tasks. Returns the seconds
+    until all lanes finished.
+    """
+    errors = []
+
+    def run(wflow):
+        try:
+            wflow.workflow()
+        except Exception as e:
+            errors.append(e)
+
+    start = time.time()
+    threads = [threading.Thread(target=run, args=(wflow,)) for wflow in wflows]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    seconds = time.time() - start
+    for e in errors:
+        print("ERROR WITHIN LANE: %s" % (e))
+    return seconds
+
+
+def measure(phase, tmp_dir, func):
+    """
+    Runs one phase and returns its measurements: what func returns (items and bytes) plus seconds, throughput, peak
+    RSS of this process and of its children (pigz, tar) running at once, and peak size of the tmp dir, all sampled
+    during this phase only.
+    """
+    # ru_maxrss in KB on Linux, highest over the whole lifetime
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    maxrss_children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024
+    sampler = DiskSampler(tmp_dir)
+    sampler.start()
+    start = time.time()
+    result = func()
+    result["seconds"] = time.time() - start
+    result["tmp_peak"] = sampler.stop()
+    result["phase"] = phase
+    result["items_per_s"] = result["items"] / result["seconds"] if result["seconds"] else 0
+    result["bytes_per_s"] = result["bytes"] / result["seconds"] if result["seconds"] else 0
+    # A lifetime high set during this phase is its exact peak, sampling may miss short spikes
+    result["rss_peak"] = sampler.rss_peak
+    if resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024 > maxrss:
+        result["rss_peak"] = max(sampler.rss_peak, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024)
+    result["rss_peak_children"] = sampler.rss_peak_children
+    if resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024 > maxrss_children:
+        result["rss_peak_children"] = max(sampler.rss_peak_children,
+                                          resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024)
+    print("BENCH\t%s\t%i items\t%.1f MB\t%.2f s\t%.1f items/s\t%.1f MB/s\tRSS %.1f MB (children %.1f MB)\ttmp %.1f MB"
+          % (phase, result["items"], result["bytes"] / 1024.0 ** 2, result["seconds"], result["items_per_s"],
+             result["bytes_per_s"] / 1024.0 ** 2, result["rss_peak"] / 1024.0 ** 2,
+             result["rss_peak_children"] / 1024.0 ** 2, result["tmp_peak"] / 1024.0 ** 2))
+    return result
+
+
+def bench_xml(cart, session, work_dir, lanes):
+    wflows = [gp.GatherXMLWorkflow(cart[i::lanes], 1, work_dir, session) for i in xrange(lanes)]
+    run_lanes(wflows)
+    xml_dir = os.path.join(work_dir, "XML")
+    xmls = [name for name in os.listdir(xml_dir) if name.endswith(".xml")]
+    return {"items": len(xmls), "bytes": dir_size(xml_dir)}
+
+
+def bench_download(cart, session, work_dir, tmp_dir, lanes, segments, segment_threshold):
+    xml_dir = os.path.join(work_dir, "XML")
+    items = []
+    for oid, project in cart:
+        if os.path.exists(os.path.join(xml_dir, "%s.xml" % (oid))):
+            bundle = gp.oid_bundle_url(os.path.join(xml_dir, "%s.xml" % (oid)), oid)
+        elif os.path.exists(os.path.join(xml_dir, "proj_%s.xml" % (oid))):
+            bundle = gp.project_bundle_url(os.path.join(xml_dir, "proj_%s.xml" % (oid)), oid)
+        else:
+            continue
+        if bundle:
+            items.append((oid,) + bundle)
+
+    wflows = [gp.GatherDownload(items[i::lanes], session, work_dir, tmp_dir, False, None, segments,
+                                segment_threshold) for i in xrange(lanes)]
+    run_lanes(wflows)
+    bundles = bundle_paths(work_dir)
+    return {"items": len(bundles), "bytes": sum(os.path.getsize(path) for path in bundles)}
+
+
+def bundle_paths(work_dir):
+    dl_dir = os.path.join(work_dir, "Downloads")
+    return [os.path.join(dl_dir, name) for name in sorted(os.listdir(dl_dir)) if name.endswith(".tar.gz")]
+
+
+def bench_shrink(work_dir, tmp_dir, codec, unassembled):
+    dl_dir = os.path.join(work_dir, "Downloads")
+    shrink = gp.GatherShrink(None, work_dir, tmp_dir, unassembled, False, codec)
+    items = 0
+    bytes_in = 0
+    bytes_out = 0
+    for path in bundle_paths(work_dir):
+        key = os.path.basename(path).split(".")[0]
+        pre_path = os.path.join(tmp_dir, "pre_%s.tar.gz" % (key))
+        shutil.copyfile(path, pre_path)
+        bytes_in += os.path.getsize(pre_path)
+        stored = shrink.post_process_tar(pre_path, key, tmp_dir, dl_dir, unassembled, False, "bench")
+        if stored:
+            items += 1
+            bytes_out += os.path.getsize(stored)
+    print("BENCH\tshrink\t%s level %s, %i threads\t%.1f MB saved" % (codec.name, codec.level, codec.threads,
+                                                                  (bytes_in - bytes_out) / 1024.0 ** 2))
+    return {"items": items, "bytes": bytes_in, "bytes_out": bytes_out}
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser("Offline benchmark of genomeportal_pyflow.py against a mock JGI portal.")
+    parser.add_argument("--oids", dest='oids', help="Size of the synthetic genome cart. Default: %i" % (50), type=int,
+                        default=50, required=False)
+    parser.add_argument("-c", "--connection-limit", dest='con_limit', help="Lanes per phase. Default: %i" % (5),
+                        type=int, default=5, required=False)
+    parser.add_argument("--bundle-size", dest='bundle_size',
+                        help="Mean uncompressed bundle size in MB. Default: %i" % (64), type=float, default=64,
+                        required=False)
+    parser.add_argument("--size-spread", dest='spread', help="Bundle sizes vary by this fraction around the mean. Default: %.1f" % (0.5),
+                        type=float, default=0.5, required=False)
+    parser.add_argument("--missing", dest='missing',
+                        help="Fraction of OIDs only available through their project. Default: %.1f" % (0.1),
+                        type=float, default=0.1, required=False)
+    parser.add_argument("--latency", dest='latency', help="Seconds added to every request. Default: %.1f" % (0),
+                        type=float, default=0, required=False)
+    parser.add_argument("--throttle", dest='throttle',
+                        help="Fraction of requests answered with 429. Default: %.1f" % (0), type=float, default=0,
+                        required=False)
+    parser.add_argument("--drop", dest='drop', help="Fraction of transfers cut off. Default: %.1f" % (0), type=float,
+                        default=0, required=False)
+    parser.add_argument("--segments", dest='segments', help="Segments per bundle download. Default: %i" % (1),
+                        type=int, default=1, required=False)
+    parser.add_argument("--segment-threshold", dest='segment_threshold',
+                        help="Minimal bundle size in MB for segmented downloads. Default: %i" % (16), type=int,
+                        default=16, required=False)
+    parser.add_argument("--shrink-threads", dest='shrink_threads',
+                        help="Threads of the codec per shrinked bundle. Default: %i" % (4), type=int, default=4,
+                        required=False)
+    parser.add_argument("--codec", dest='codec', help="Recompression of shrinked bundles. Default: %s" % ("gzip"),
+                        choices=sorted(gp.Codec.CODECS), default="gzip", required=False)
+    parser.add_argument("--level", dest='level', help="Compression level of the codec. Default: the codec's default",
+                        type=int, default=None, required=False)
+    parser.add_argument("-u", "--remove-unassembled", dest="unassembled",
+                        help="Shrink unassembled files as well.", required=False, default=False, action='store_true')
+    parser.add_argument("--request-rate", dest='request_rate',
+                        help="Requests per second to the mock portal, throttling still halves it. Default: %i" % (1000),
+                        type=float, default=1000, required=False)
+    parser.add_argument("--portal-url", dest='portal_url',
+                        help="Use a running mock_jgi_portal.py (whose settings then apply) instead of starting one.",
+                        default=None, required=False)
+    parser.add_argument("--work-dir", dest='work_dir',
+                        help="Directory for XMLs, downloads, tmp files and generated bundles. Default: a new tmp dir, removed at exit",
+                        default=None, required=False)
+    parser.add_argument("--json", dest='json', help="Write the measurements of all phases to this file.",
+                        default=None, required=False)
+
+    args = parser.parse_args()
+
+    return (args)
+
+
+def main():
+    args = parse_arguments()
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="bench_gp_")
+    tmp_dir = os.path.join(work_dir, "tmp")
+    for sub_dir in ("XML", "Downloads", os.path.join("Downloads", "shrinked"), "tmp"):
+        if not os.path.exists(os.path.join(work_dir, sub_dir)):
+            os.makedirs(os.path.join(work_dir, sub_dir))
+
+    server = None
+    portal_url = args.portal_url
+    if not portal_url:
+        portal = mock.MockPortal(os.path.join(work_dir, "portal"), args.bundle_size, mock.LAYOUT, args.spread,
+                                 args.missing, args.latency, args.throttle, args.drop)
+        server, portal_url = mock.start(portal)
+    gp.PORTAL_URL = gp.IMG_URL = portal_url.rstrip("/")
+    gp.SIGNON_URL = "%s/signon/create" % (gp.PORTAL_URL)
+
+    cart = [[str(2000000000 + i), mock.project_of(str(2000000000 + i))] for i in xrange(args.oids)]
+    rate = gp.RateController(args.request_rate, args.request_rate, args.con_limit)
+    session = gp.JGISession({}, args.con_limit, rate)
+
+    results = []
+    try:
+        if not args.portal_url:
+            # Generate all bundles up front, so the XML phase measures requests and not the mock's gzip
+            measure("generate", tmp_dir, lambda: {
+                "items": len([portal.bundle_path(oid) for oid, project in cart]),
+                "bytes": sum(os.path.getsize(portal.bundle_path(oid)) for oid, project in cart)})
+        results.append(measure("xml", tmp_dir, lambda: bench_xml(cart, session, work_dir, args.con_limit)))
+        results.append(measure("download", tmp_dir, lambda: bench_download(
+            cart, session, work_dir, tmp_dir, args.con_limit, args.segments, args.segment_threshold)))
+        results.append(measure("shrink", tmp_dir, lambda: bench_shrink(
+            work_dir, tmp_dir, gp.Codec(args.codec, args.level, args.shrink_threads), args.unassembled)))
+    finally:
+        if server:
+            server.shutdown()
+            server.server_close()
+        if not args.work_dir:
+            shutil.rmtree(work_dir)
+
+    if args.json:
+        outFile = open(args.json, "w")
+        json.dump(results, outFile, indent=2)
+        outFile.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+#!/usr/bin/env python2.7
+# coding=utf-8
+
+"""
+	concat_seqs.py
+
+	Date:   18/10/2026
+	Usage:  For usage instructions run with option --help
+	Author: Madis Rumming <mrumming@cebitec.uni-bielefeld.de>
+"""
+
+
+
+__author__  = "Madis Rumming <mrumming@cebitec.uni-bielefeld.de>"
+__copyright__ = "Copyright 2016, Computational Metagenomics, Faculty of Technology, Bielefeld University"
+
+__version__ = "1.1"
+__maintainer__ = "Madis Rumming"
+__email__ = "mrumming@cebitec.uni-bielefeld.de"
+__status__ = "Production"
+
+
+import argparse
+import os.path
+import sys
+
+# Gather step of the scatter-gather demultiplexing of 16s_pyflow.py. Every sample was filtered by its own
+# split_libraries_fastq.py run, which numbers its reads SampleID_0, SampleID_1, ... from zero. One run over all
+# samples numbers them in a single sequence in the order of its -i list instead, so the per-sample seqs.fna are
+# concatenated in that order while the numbers are shifted by the count of all reads before.
+
+
+
+def parse_arguments():
+	parser = argparse.ArgumentParser("Concatenates per-sample seqs.fna of split_libraries_fastq.py into one seqs.fna, renumbering the reads as one run over all samples would have done.")
+	parser.add_argument("-o", "--output", dest='output', help="Path of the combined seqs.fna.", required=True, type=str)
+	parser.add_argument("inputs", help="Per-sample seqs.fna, in the order of the samples.", nargs='+')
+
+	args = parser.parse_args()
+
+	return(args)
+
+
+
+def concat(inputs, output):
+	"""
+	Streams all inputs into output and returns the number of reads written.
+	"""
+	if not os.path.exists(os.path.dirname(os.path.abspath(output))):
+		os.makedirs(os.path.dirname(os.path.abspath(output)))
+
+	offset = 0
+	outFile = open(output+".part", "w", 1 << 20)
+	for path in inputs:
+		count = 0
+		inFile = open(path, "r", 1 << 20)
+		for line in inFile:
+			if line.startswith(">"):
+				# >SampleID_7 M01234:12:000000000-A1B2C:1:1101:15589:1331 orig_bc=AAAAAAAAAAAA new_bc=...
+				label, sep, rest = line[1:].rstrip("\n").partition(" ")
+				sample, num = label.rsplit("_", 1)
+				count = max(count, int(num)+1)
+				line = ">%s_%i%s%s\n" % (sample, int(num)+offset, sep, rest)
+			outFile.write(line)
+		inFile.close()
+		offset += count
+	outFile.close()
+	os.rename(output+".part", output)
+	return offset
+
+
+
+def main():
+	args = parse_arguments()
+	for path in args.inputs:
+		if not os.path.exists(path):
+			sys.exit("Specified input %s does not exist." % (path))
+
+	count = concat(args.inputs, args.output)
+	print("Wrote %i reads of %i samples to %s" % (count, len(args.inputs), args.output))
+
+
+if __name__ == "__main__":
+	main()
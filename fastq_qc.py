@@ -0,0 +1,223 @@
+#!/usr/bin/env python2.7
+# coding=utf-8
+
+"""
+	fastq_qc.py
+
+	Date:   18/10/2026
+	Usage:  For usage instructions run with option --help
+	Author: Madis Rumming <mrumming@cebitec.uni-bielefeld.de>
+"""
+
+
+
+__author__  = "Madis Rumming <mrumming@cebitec.uni-bielefeld.de>"
+__copyright__ = "Copyright 2016, Computational Metagenomics, Faculty of Technology, Bielefeld University"
+
+__version__ = "1.1"
+__maintainer__ = "Madis Rumming"
+__email__ = "mrumming@cebitec.uni-bielefeld.de"
+__status__ = "Production"
+
+
+import argparse
+import gzip
+import io
+import json
+import os.path
+import sys
+from itertools import islice
+
+import numpy as np
+
+# Streaming QC of the merged reads of one sample, run by 16s_pyflow.py after each FLASH task. Reads are taken in
+# batches and every statistic is computed on the whole batch at once: the quality strings of a batch are joined into
+# one byte array, each byte gets its position within its read, and per-position sums and histograms are bincounts
+# over these positions.
+
+
+
+# Phred+33 encoded qualities, 0 up to 93
+PHRED_OFFSET = 33
+QMAX = 94
+
+
+
+def parse_arguments():
+	parser = argparse.ArgumentParser("Computes per-position quality, length distribution, N content and merge rate of the FLASH output of one sample and writes them as a compact JSON summary. With --combine, collects the summaries of all samples into one table instead.")
+	parser.add_argument("-s", "--sample", dest='sample', help="Sample identifier to report.", required=False, default=None, type=str)
+	parser.add_argument("-i", "--merged", dest='merged', help="Merged reads, i.e. <sample>.extendedFrags.fastq(.gz).", required=False, default=None, type=str)
+	parser.add_argument("-n", "--not-combined", dest='not_combined', help="Forward reads of unmerged pairs, i.e. <sample>.notCombined_1.fastq(.gz). Without it no merge rate is reported.", required=False, default=None, type=str)
+	parser.add_argument("-o", "--output", dest='output', help="Path of the JSON summary or, with --combine, of the table.", required=True, type=str)
+	parser.add_argument("-b", "--batch-size", dest='batch_size', help="Reads per batch, a batch of 450bp reads peaks at about 200 MB. Default: %i" % (20000), default=20000, type=int, required=False)
+	parser.add_argument("--combine", dest='combine', help="Tab-separated table of these JSON summaries, one line per sample.", required=False, default=None, nargs='+')
+
+	args = parser.parse_args()
+
+	return(args)
+
+
+
+def open_fastq(path):
+	if path.endswith(".gz"):
+		return io.BufferedReader(gzip.open(path, "rb"), 1 << 20)
+	return open(path, "rb", 1 << 20)
+
+
+
+def batches(path, batch_size):
+	"""
+	Yields lists of (sequence, quality) lines of up to batch_size reads, without line breaks.
+	"""
+	inFile = open_fastq(path)
+	while True:
+		lines = list(islice(inFile, 4*batch_size))
+		if not lines:
+			break
+		yield [line.rstrip("\r\n") for line in lines[1::4]], [line.rstrip("\r\n") for line in lines[3::4]]
+	inFile.close()
+
+
+
+def count_reads(path):
+	inFile = open_fastq(path)
+	lines = 0
+	for line in inFile:
+		lines += 1
+	inFile.close()
+	return lines/4
+
+
+
+def grow(array, rows):
+	"""
+	Pads the first axis of array with zeros up to rows.
+	"""
+	if array.shape[0] >= rows:
+		return array
+	return np.concatenate([array, np.zeros((rows-array.shape[0],)+array.shape[1:], dtype=array.dtype)])
+
+
+
+class FastqStats(object):
+	"""
+	Accumulates the statistics of one FASTQ file batch by batch.
+	"""
+
+	def __init__(self):
+		self.reads = 0
+		self.lengths = np.zeros(0, dtype=np.int64)
+		# Histogram of qualities per position, positions x QMAX
+		self.qualities = np.zeros((0, QMAX), dtype=np.int64)
+		self.n_bases = np.zeros(0, dtype=np.int64)
+
+	def add(self, seqs, quals):
+		lengths = np.fromiter((len(qual) for qual in quals), dtype=np.int64, count=len(quals))
+		if not len(lengths):
+			return
+		maxlen = int(lengths.max())+1
+		self.lengths = grow(self.lengths, maxlen)
+		self.lengths += np.bincount(lengths, minlength=self.lengths.shape[0])
+		self.reads += len(lengths)
+
+		# Position of every base within its read. Per-base arrays are int32 or uint8 and updated in place, they are
+		# the bulk of the memory a batch takes.
+		starts = (np.cumsum(lengths) - lengths).astype(np.int32)
+		positions = np.arange(lengths.sum(), dtype=np.int32)
+		positions -= np.repeat(starts, lengths)
+
+		qual = np.clip(np.frombuffer("".join(quals), dtype=np.uint8), PHRED_OFFSET, PHRED_OFFSET+QMAX-1)
+		index = positions*QMAX
+		index += qual
+		index -= PHRED_OFFSET
+		del qual
+		self.qualities = grow(self.qualities, maxlen)
+		self.qualities += np.bincount(index, minlength=self.qualities.size).reshape(self.qualities.shape)
+		del index
+
+		seq = np.frombuffer("".join(seqs), dtype=np.uint8)
+		self.n_bases = grow(self.n_bases, maxlen)
+		self.n_bases += np.bincount(positions[(seq == ord("N")) | (seq == ord("n"))], minlength=self.n_bases.shape[0])
+
+	def quantile(self, q):
+		"""
+		Per-position quality below which a fraction q of the bases at that position lie.
+		"""
+		cum = np.cumsum(self.qualities, axis=1)
+		return (cum < q*cum[:, -1:]).sum(axis=1)
+
+	def summary(self):
+		bases = self.qualities.sum(axis=1)
+		covered = np.maximum(bases, 1)
+		scores = np.arange(QMAX)
+		total = max(int(bases.sum()), 1)
+		lengths = np.arange(self.lengths.shape[0])
+		nonzero = np.nonzero(self.lengths)[0]
+		return {
+			"reads": self.reads,
+			"bases": int(bases.sum()),
+			"mean_quality": round(float((self.qualities*scores).sum())/total, 2),
+			"n_fraction": round(float(self.n_bases.sum())/total, 6),
+			"length": {
+				"min": int(nonzero[0]) if len(nonzero) else 0,
+				"max": int(nonzero[-1]) if len(nonzero) else 0,
+				"mean": round(float((self.lengths*lengths).sum())/max(self.reads, 1), 2),
+				# Reads per length, starting at length 0
+				"histogram": self.lengths.tolist()},
+			# Per-position values, starting at position 0
+			"position": {
+				"bases": bases.tolist(),
+				"mean_quality": np.round((self.qualities*scores).sum(axis=1)/covered.astype(float), 2).tolist(),
+				"q10": self.quantile(0.1).tolist(),
+				"median": self.quantile(0.5).tolist(),
+				"q90": self.quantile(0.9).tolist(),
+				"n_fraction": np.round(self.n_bases/covered.astype(float), 6).tolist()}}
+
+
+
+def fastq_summary(sample, merged, not_combined, batch_size):
+	stats = FastqStats()
+	for seqs, quals in batches(merged, batch_size):
+		stats.add(seqs, quals)
+	summary = stats.summary()
+	summary["sample"] = sample
+	if not_combined:
+		summary["not_combined"] = count_reads(not_combined)
+		summary["merge_rate"] = round(float(stats.reads)/max(stats.reads+summary["not_combined"], 1), 4)
+	return summary
+
+
+
+def combine(paths, output):
+	outFile = open(output, "w")
+	outFile.write("#SampleID\treads\tnot_combined\tmerge_rate\tmean_length\tmean_quality\tn_fraction\n")
+	for path in paths:
+		inFile = open(path)
+		summary = json.load(inFile)
+		inFile.close()
+		outFile.write("%s\t%i\t%s\t%s\t%.2f\t%.2f\t%f\n" % (summary["sample"], summary["reads"], summary.get("not_combined", "NA"), summary.get("merge_rate", "NA"), summary["length"]["mean"], summary["mean_quality"], summary["n_fraction"]))
+	outFile.close()
+
+
+
+def main():
+	args = parse_arguments()
+
+	if args.combine:
+		combine(args.combine, args.output)
+		return
+
+	if not args.merged or not os.path.exists(args.merged):
+		sys.exit("Specified merged reads %s do not exist." % (args.merged))
+	if args.not_combined and not os.path.exists(args.not_combined):
+		sys.exit("Specified unmerged reads %s do not exist." % (args.not_combined))
+
+	summary = fastq_summary(args.sample or os.path.basename(args.merged).split(".")[0], args.merged, args.not_combined, args.batch_size)
+	outFile = open(args.output+".part", "w")
+	json.dump(summary, outFile, separators=(",", ":"), sort_keys=True)
+	outFile.close()
+	os.rename(args.output+".part", args.output)
+
+
+if __name__ == "__main__":
+	main()
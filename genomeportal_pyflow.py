@@ -19,12 +19,27 @@ __status__ = "Production"
 
 
 import requests
+from requests.adapters import HTTPAdapter
 import argparse
 import os.path
 import sys
+import errno
+import json
 from lxml import etree
 import subprocess
 import shlex
+import Queue
+import shutil
+import threading
+import tarfile
+import fnmatch
+import tempfile
+import time
+import random
+import heapq
+import hashlib
+import sqlite3
+import multiprocessing
 
 # Manual import of magic as module (DO NOT USE THE CEBITEC NATIVE ONE!!!)
 import imp
@@ -35,6 +50,1225 @@ magic = imp.load_source("magic", "/vol/cmg/share/virtualenvironments/pyflows/lib
 sys.path.append("/vol/cmg/share/virtualenvironments/pyflows/lib/python2.7/site-packages/pyflow/")
 from pyflow import WorkflowRunner
 
+# JGI endpoints, all three are replaced by --portal-url (e.g. to run against mock_jgi_portal.py)
+PORTAL_URL = "http://genome.jgi.doe.gov"
+IMG_URL = "https://img.jgi.doe.gov"
+SIGNON_URL = "https://signon.jgi.doe.gov/signon/create"
+
+# Size of the chunks in which bundle downloads are streamed to disk. Bounds the memory used per download lane.
+CHUNK_SIZE = 1024 * 1024
+
+
+def file_md5(path, prefix=None):
+    """
+    Returns the MD5 hash object of a file, or of its first prefix bytes.
+    """
+    md5 = hashlib.md5()
+    inFile = open(path, "rb")
+    remaining = prefix
+    while remaining is None or remaining > 0:
+        chunk = inFile.read(CHUNK_SIZE if remaining is None else min(CHUNK_SIZE, remaining))
+        if not chunk:
+            break
+        md5.update(chunk)
+        if remaining is not None:
+            remaining -= len(chunk)
+    inFile.close()
+    return md5
+
+
+def write_response(r, path):
+    """
+    Streams the body of a (stream=True) response chunk-wise into path, so bundles are never held in memory.
+    """
+    outFile = open(path, "wb")
+    try:
+        for chunk in r.iter_content(chunk_size=CHUNK_SIZE):
+            if chunk:
+                outFile.write(chunk)
+    finally:
+        outFile.close()
+        r.close()
+
+
+def write_descriptor(path, xml):
+    """
+    Writes a directory XML unless the file already holds exactly this content. Unchanged descriptions keep their
+    mtime, so the catalog does not parse them again.
+    """
+    if os.path.exists(path) and os.path.getsize(path) == len(xml):
+        inFile = open(path, "rb")
+        same = inFile.read() == xml
+        inFile.close()
+        if same:
+            return False
+    outFile = open(path + ".tmp", "wb")
+    outFile.write(xml)
+    outFile.close()
+    os.rename(path + ".tmp", path)
+    return True
+
+
+class Manifest(object):
+    """
+    Completion manifest of the download directory. One tab-separated line per successfully stored bundle: OID, URL,
+    size, MD5 and output path. Every line is appended with a single write and synced to disk, so a crash can at most
+    leave a truncated last line, which is ignored when reading.
+    """
+
+    COLUMNS = 5
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def read(self):
+        """
+        Returns the last complete entry of every OID found in the manifest.
+        """
+        entries = {}
+        if os.path.exists(self.path):
+            inFile = open(self.path)
+            for line in inFile:
+                if not line.endswith("\n"):
+                    continue
+                line = line.rstrip("\n").split("\t")
+                if len(line) == self.COLUMNS:
+                    entries[line[0]] = line
+            inFile.close()
+        return entries
+
+    def record(self, oid, url, path, md5=None):
+        if md5 is None:
+            md5 = file_md5(path).hexdigest()
+        line = "%s\t%s\t%i\t%s\t%s\n" % (oid, url, os.path.getsize(path), md5, os.path.abspath(path))
+        with self.lock:
+            fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0644)
+            try:
+                os.write(fd, line)
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+        return md5
+
+
+class Telemetry(object):
+    """
+    Structured instrumentation as JSON lines: one object per HTTP request, bundle transfer and post-processing step,
+    with event type, run, lane (the thread of the pyflow task), time stamp and duration in seconds. Runs are appended
+    to the same file and told apart by their start time; summarize_telemetry evaluates the last one.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.run = time.time()
+        self.lock = threading.Lock()
+        self.outFile = open(path, "a")
+
+    def event(self, kind, **fields):
+        fields.update(event=kind, run=self.run, time=time.time(), lane=threading.current_thread().name)
+        line = json.dumps(fields) + "\n"
+        with self.lock:
+            self.outFile.write(line)
+            self.outFile.flush()
+
+
+def percentile(values, q):
+    """
+    Nearest rank percentile of sorted values.
+    """
+    if not values:
+        return 0
+    return values[min(len(values) - 1, int(q / 100.0 * len(values)))]
+
+
+def summarize_telemetry(path, dest_dir):
+    """
+    Prints the summary of the last run recorded in a telemetry file and appends it as summary event: request latency
+    percentiles, throughput and utilization per lane, post-processing time and bytes saved by shrinking, error pages.
+    """
+    events = []
+    inFile = open(path)
+    for line in inFile:
+        try:
+            events.append(json.loads(line))
+        except ValueError:
+            continue
+    inFile.close()
+    if not events:
+        return
+    run = max(e["run"] for e in events)
+    events = [e for e in events if e["run"] == run]
+    wall = max(e["time"] for e in events) - run
+
+    summary = {"event": "summary", "run": run, "time": time.time(), "wall": wall}
+    requests_ = [e for e in events if e["event"] == "request"]
+    latency = sorted(e["seconds"] for e in requests_)
+    summary["requests"] = len(requests_)
+    summary["failed_requests"] = len([e for e in requests_ if not e["status"] or e["status"] >= 400])
+    for q in (50, 90, 99):
+        summary["latency_p%i" % (q)] = percentile(latency, q)
+    print("TELEMETRY\t%i requests (%i failed), latency p50 %.3fs p90 %.3fs p99 %.3fs" % (
+        len(requests_), summary["failed_requests"], summary["latency_p50"], summary["latency_p90"],
+        summary["latency_p99"]))
+
+    lanes = {}
+    for e in events:
+        if e["event"] in ("transfer", "filter", "shrink", "verify"):
+            lane = lanes.setdefault(e["lane"], {"bytes": 0, "busy": 0.0})
+            # Shrinking lanes are rated by the bundle bytes they process
+            lane["bytes"] += e.get("received") or e.get("bytes_in", 0)
+            lane["busy"] += e["seconds"]
+    for name in sorted(lanes):
+        lane = lanes[name]
+        lane["utilization"] = lane["busy"] / wall if wall else 0
+        lane["rate"] = lane["bytes"] / lane["busy"] if lane["busy"] else 0
+        print("TELEMETRY\t%s\t%.1f GB\t%.1f MB/s\tutilization %.0f%%" % (
+            name, lane["bytes"] / 1024.0 ** 3, lane["rate"] / 1024.0 ** 2, lane["utilization"] * 100))
+    summary["lanes"] = lanes
+
+    shrinks = [e for e in events if e["event"] in ("filter", "shrink")]
+    durations = sorted(e["seconds"] for e in shrinks)
+    summary["shrinked"] = len(shrinks)
+    summary["shrink_p50"] = percentile(durations, 50)
+    summary["shrink_p90"] = percentile(durations, 90)
+    summary["bytes_saved"] = sum(e["bytes_in"] - e["bytes_out"] for e in shrinks if e.get("bytes_in"))
+    print("TELEMETRY\t%i bundles shrinked, p50 %.1fs p90 %.1fs, %.1f GB saved" % (
+        len(shrinks), summary["shrink_p50"], summary["shrink_p90"], summary["bytes_saved"] / 1024.0 ** 3))
+
+    verified = [e for e in events if e["event"] == "verify"]
+    summary["verified"] = len(verified)
+    summary["corrupt"] = len([e for e in verified if not e["intact"]])
+    print("TELEMETRY\t%i bundles verified, %i corrupt" % (summary["verified"], summary["corrupt"]))
+
+    errors = 0
+    for sub_dir, prefix in (("Downloads", "ERROR_"), ("XML", "ERR_")):
+        sub_dir = os.path.join(dest_dir, sub_dir)
+        if os.path.exists(sub_dir):
+            for name in os.listdir(sub_dir):
+                if name.startswith(prefix) and os.path.getmtime(os.path.join(sub_dir, name)) >= run:
+                    errors += 1
+    summary["error_pages"] = errors
+    print("TELEMETRY\t%i error pages written" % (errors))
+
+    outFile = open(path, "a")
+    outFile.write(json.dumps(summary) + "\n")
+    outFile.close()
+
+
+class TransferLog(object):
+    """
+    Throughput history of the download directory, kept across runs for planning. One tab-separated line per received
+    bundle or file: OID, bytes received by the lane and seconds it took.
+    """
+
+    # Most recent transfers the projected throughput is based on
+    RECENT = 200
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def record(self, oid, received, seconds):
+        with self.lock:
+            outFile = open(self.path, "a")
+            outFile.write("%s\t%i\t%.3f\n" % (oid, received, seconds))
+            outFile.close()
+
+    def throughput(self):
+        """
+        Returns the bytes per second of a single lane in recent runs, None if nothing was measured yet.
+        """
+        transfers = []
+        if os.path.exists(self.path):
+            inFile = open(self.path)
+            for line in inFile:
+                line = line.rstrip("\n").split("\t")
+                if len(line) == 3:
+                    transfers.append((int(line[1]), float(line[2])))
+            inFile.close()
+        transfers = transfers[-self.RECENT:]
+        seconds = sum(t[1] for t in transfers)
+        if not seconds:
+            return None
+        return sum(t[0] for t in transfers) / seconds
+
+
+class ArtifactIndex(object):
+    """
+    URL-level dedupe index shared by all download and shrinking lanes. The first OID claiming a bundle URL fetches
+    and shrinks it, every further OID resolving to the same URL is not downloaded again but hardlinked to the stored
+    artifact (copied if linking fails) as soon as it is there, and recorded in the manifest like a download of its own.
+    A claim only covers the URL claimed: if it does not deliver the bundle, the owner abandons it and the waiting
+    OIDs fetch on their own. If the owner never stores the bundle, its duplicates stay unrecorded and are retried by
+    the next run.
+    With a verification queue, stored artifacts are only recorded and linked once the verification lanes found them
+    intact. Corrupt ones are renamed to *.corrupt, listed in corrupt.tsv and, as they are not in the manifest,
+    downloaded again by the next run.
+    """
+
+    def __init__(self, manifest, verify_queue=None):
+        self.manifest = manifest
+        self.verify_queue = verify_queue
+        # Full URL -> MD5 listed in the directory XMLs
+        self.checksums = {}
+        self.lock = threading.Lock()
+        # URL -> OID fetching it
+        self.owners = {}
+        # URL -> (owner OID, stored path, MD5)
+        self.stored = {}
+        # URL -> OIDs waiting for the artifact
+        self.waiting = {}
+
+    def claim(self, url, key):
+        """
+        Returns True if key has to fetch url itself, False if it is (or will be) linked to the artifact of another OID.
+        """
+        with self.lock:
+            owner = self.owners.setdefault(url, key)
+            if owner == key:
+                return True
+            artifact = self.stored.get(url)
+            if artifact is None:
+                self.waiting.setdefault(url, []).append(key)
+                print("DEDUPLICATED FILE: %s of %s waits for %s" % (url, key, owner))
+                return False
+        self.link(key, url, *artifact)
+        return False
+
+    def checksum(self, url):
+        return self.checksums.get(url)
+
+    def store(self, key, url, path, md5=None):
+        """
+        Hands a stored artifact over to verification or commits it right away.
+        """
+        if self.verify_queue:
+            self.verify_queue.put((key, url, path, md5))
+        else:
+            self.commit(key, url, path, md5)
+
+    def commit(self, key, url, path, md5=None):
+        """
+        Records a stored artifact and links all OIDs waiting for the URL it was fetched from.
+        """
+        md5 = self.manifest.record(key, url, path, md5)
+        with self.lock:
+            self.owners.setdefault(url, key)
+            self.stored[url] = (key, path, md5)
+            pending = self.waiting.pop(url, [])
+        for dup in pending:
+            self.link(dup, url, key, path, md5)
+
+    def abandon(self, url, key):
+        """
+        Drops the claim of key on a URL that did not deliver the bundle. Returns the OIDs that waited for it, they
+        are not linked to anything and have to be fetched on their own.
+        """
+        with self.lock:
+            if self.owners.get(url) == key:
+                del self.owners[url]
+            waiting = self.waiting.pop(url, [])
+        for dup in waiting:
+            print("ABANDONED FILE: %s of %s, released %s" % (url, key, dup))
+        return waiting
+
+    def link(self, key, url, owner, path, md5):
+        name = os.path.basename(path)
+        if name.startswith(owner):
+            name = key + name[len(owner):]
+        else:
+            name = "%s_%s" % (key, name)
+        dup_path = os.path.join(os.path.dirname(path), name)
+        if os.path.lexists(dup_path):
+            os.remove(dup_path)
+        try:
+            os.link(path, dup_path)
+        except OSError:
+            shutil.copyfile(path, dup_path)
+        print("LINKED FILE: %s to %s" % (dup_path, path))
+        self.manifest.record(key, url, dup_path, md5)
+
+    def reject(self, key, url, path, reason):
+        """
+        Keeps a corrupt artifact out of the manifest, so it is downloaded again by the next run.
+        """
+        print("CORRUPT FILE: %s of %s: %s" % (path, key, reason))
+        if os.path.exists(path):
+            os.rename(path, path + ".corrupt")
+        with self.lock:
+            outFile = open(os.path.join(os.path.dirname(self.manifest.path), "corrupt.tsv"), "a")
+            outFile.write("%s\t%s\t%s\t%s\n" % (key, url, os.path.abspath(path), " ".join(reason.split())))
+            outFile.close()
+
+
+class PartialDownload(object):
+    """
+    Partially received bundle kept in a partial directory together with a small JSON journal recording URL, expected
+    size and bytes received. The directory is in the tmp dir for bundles that are shrinked afterwards and in the
+    download dir otherwise, so the finished bundle is moved within one filesystem. An interrupted or restarted transfer continues with a Range
+    request from the last good offset and falls back to a full fetch if the server ignores the range.
+    Large bundles can be split into byte ranges [first, last, received] that are fetched concurrently into a
+    preallocated part file; the journal then records the progress of every segment.
+    """
+
+    # Content types under which the genome portal delivers bundles
+    BUNDLE_TYPES = ("application/x-gzip", "application/octet-stream")
+    # Chunks written between two journal updates
+    JOURNAL_INTERVAL = 32
+
+    def __init__(self, part_dir, name, url):
+        self.name = name
+        self.part_path = os.path.join(part_dir, "%s.part" % (name))
+        self.journal_path = os.path.join(part_dir, "%s.journal" % (name))
+        self.url = url
+        self.size = None
+        self.received = 0
+        self.segments = None
+        self.md5 = None
+        self.lock = threading.Lock()
+
+        try:
+            os.makedirs(part_dir)
+        except OSError as e:
+            if not e.errno == errno.EEXIST:
+                raise
+
+        if os.path.exists(self.journal_path) and os.path.exists(self.part_path):
+            inFile = open(self.journal_path)
+            journal = json.load(inFile)
+            inFile.close()
+            if journal["url"] == url:
+                self.size = journal["size"]
+                # Only trust bytes that actually reached the disk
+                self.received = min(journal["received"], os.path.getsize(self.part_path))
+                self.segments = journal.get("segments")
+
+    def headers(self):
+        if self.received > 0 and self.segments is None:
+            return {"Range": "bytes=%i-" % (self.received)}
+        return {}
+
+    def write_journal(self):
+        with self.lock:
+            outFile = open(self.journal_path + ".tmp", "w")
+            json.dump({"url": self.url, "size": self.size, "received": self.received, "segments": self.segments},
+                      outFile)
+            outFile.close()
+            os.rename(self.journal_path + ".tmp", self.journal_path)
+
+    def write(self, r, path):
+        """
+        Appends the body of r to the partial file and moves it to path once complete. Raises IOError if the
+        transfer ends early; the journal then allows to resume it.
+        """
+        if r.status_code == 206 and self.received > 0:
+            # Content-Range: bytes <first>-<last>/<total>
+            self.size = int(r.headers["Content-Range"].split("/")[-1])
+            # Catch up on the hash of the bytes received before
+            md5 = file_md5(self.part_path, self.received)
+            outFile = open(self.part_path, "r+b")
+            outFile.seek(self.received)
+            outFile.truncate()
+        else:
+            self.received = 0
+            self.size = int(r.headers["Content-Length"]) if "Content-Length" in r.headers else None
+            md5 = hashlib.md5()
+            outFile = open(self.part_path, "wb")
+
+        try:
+            for n, chunk in enumerate(r.iter_content(chunk_size=CHUNK_SIZE)):
+                if chunk:
+                    outFile.write(chunk)
+                    md5.update(chunk)
+                    self.received += len(chunk)
+                if n % self.JOURNAL_INTERVAL == 0:
+                    outFile.flush()
+                    self.write_journal()
+        finally:
+            outFile.close()
+            r.close()
+            self.write_journal()
+
+        if self.size is not None and self.received < self.size:
+            raise IOError("Transfer of %s ended after %i of %i bytes" % (self.url, self.received, self.size))
+
+        self.md5 = md5.hexdigest()
+        shutil.move(self.part_path, path)
+        os.remove(self.journal_path)
+
+    def split(self, size, n):
+        """
+        Preallocates the part file for a bundle of size bytes and divides it into n segments.
+        """
+        self.size = size
+        self.received = 0
+        step = -(-size // n)
+        self.segments = [[first, min(first + step, size) - 1, 0] for first in xrange(0, size, step)]
+
+        outFile = open(self.part_path, "wb")
+        outFile.truncate(size)
+        outFile.close()
+        self.write_journal()
+
+    def write_segment(self, session, segment):
+        first, last, received = segment
+        r = session.get(self.url, stream=True, headers={"Range": "bytes=%i-%i" % (first + received, last)})
+        if not r.status_code == 206:
+            r.close()
+            raise IOError("Range request for %s answered with status %i" % (self.url, r.status_code))
+
+        outFile = open(self.part_path, "r+b")
+        outFile.seek(first + received)
+        try:
+            for n, chunk in enumerate(r.iter_content(chunk_size=CHUNK_SIZE)):
+                if chunk:
+                    outFile.write(chunk)
+                    segment[2] += len(chunk)
+                if n % self.JOURNAL_INTERVAL == 0:
+                    outFile.flush()
+                    self.write_journal()
+        finally:
+            outFile.close()
+            r.close()
+
+        if first + segment[2] <= last:
+            raise IOError("Segment %i-%i of %s ended after %i bytes" % (first, last, self.url, segment[2]))
+
+    def write_segments(self, session, path, n_threads):
+        """
+        Fetches all incomplete segments with n_threads concurrent range requests and moves the part file to path
+        once every segment is complete.
+        """
+        pending = Queue.Queue()
+        for segment in self.segments:
+            if segment[0] + segment[2] <= segment[1]:
+                pending.put(segment)
+        errors = []
+
+        def fetch_segments():
+            while True:
+                try:
+                    segment = pending.get_nowait()
+                except Queue.Empty:
+                    return
+                try:
+                    self.write_segment(session, segment)
+                except (IOError, requests.exceptions.RequestException) as e:
+                    errors.append(e)
+
+        threads = [threading.Thread(target=fetch_segments) for i in xrange(n_threads)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.received = sum(segment[2] for segment in self.segments)
+        self.write_journal()
+        if errors:
+            raise IOError("%i segment(s) of %s failed: %s" % (len(errors), self.url, errors[0]))
+
+        shutil.move(self.part_path, path)
+        os.remove(self.journal_path)
+
+
+class Codec(object):
+    """
+    Recompression of shrinked bundles: gzip through pigz, zstd with its own threads or store, which keeps the
+    filtered tar uncompressed for immediate local use. Default levels are the fastest ones that still compress
+    the remaining tables well; on synthetic bundles gzip -9 took 17 times as long as -1 for 7% smaller output.
+    """
+
+    # Command (filled with level and threads), default level and suffix of the shrinked bundle per codec
+    CODECS = {
+        "gzip": ("pigz -%i -p %i", 1, ".tar.gz"),
+        "zstd": ("zstd -q -%i -T%i", 3, ".tar.zst"),
+        # Copied as is
+        "store": ("cat", None, ".tar"),
+    }
+
+    def __init__(self, name, level=None, threads=1):
+        self.name = name
+        self.command, default_level, self.suffix = self.CODECS[name]
+        self.level = default_level if level is None or default_level is None else level
+        self.threads = threads
+
+    def args(self):
+        if self.level is None:
+            return shlex.split(self.command)
+        return shlex.split(self.command % (self.level, self.threads))
+
+
+class TarFilter(object):
+    """
+    Single pass variant of shrinking a bundle. Reads the (gzipped) tar straight from the HTTP stream member by member,
+    drops fna, faa and gff (and unassembled) members and writes the rest to the recompressing codec, so the archive
+    is neither stored as tmp copy nor decompressed more than once.
+    With -k the keep-unassembled rule is decided on the fly: unassembled members seen before any assembled one are
+    held back in a spooled buffer until it is known whether assembled data exists.
+    """
+
+    # Member patterns as deleted by tar --wildcards (* also matches /)
+    OMIT_PATTERNS = ("*/*.f*a", "*/*.gff")
+    UNASSEMBLED_PATTERNS = ("*/*.u*",)
+    # Bytes of a held back member kept in memory before spooling to the tmp dir
+    SPOOL_SIZE = 64 * 1024 * 1024
+
+    def __init__(self, tmp_dir, unassembled, keep_unassembled, codec):
+        self.tmp_dir = tmp_dir
+        self.unassembled = unassembled
+        self.keep_unassembled = keep_unassembled
+        self.codec = codec
+
+    def matches(self, name, patterns):
+        for pattern in patterns:
+            if fnmatch.fnmatchcase(name, pattern):
+                return True
+        return False
+
+    def filter(self, inStream, outFile):
+        pigz_c = subprocess.Popen(self.codec.args(), stdin=subprocess.PIPE, stdout=outFile)
+        tar_in = tarfile.open(fileobj=inStream, mode="r|*")
+        tar_out = tarfile.open(fileobj=pigz_c.stdin, mode="w|")
+
+        assembled = False
+        held = []
+        try:
+            for member in tar_in:
+                if not assembled and (".a." in member.name or ".a," in member.name):
+                    assembled = True
+                    for member_, spool in held:
+                        spool.close()
+                    held = []
+
+                if self.matches(member.name, self.OMIT_PATTERNS):
+                    continue
+                if self.unassembled and self.matches(member.name, self.UNASSEMBLED_PATTERNS):
+                    if not self.keep_unassembled or assembled:
+                        continue
+                    spool = tempfile.SpooledTemporaryFile(max_size=self.SPOOL_SIZE, dir=self.tmp_dir)
+                    if member.isfile():
+                        shutil.copyfileobj(tar_in.extractfile(member), spool, CHUNK_SIZE)
+                        spool.seek(0)
+                    held.append((member, spool))
+                    continue
+
+                tar_out.addfile(member, tar_in.extractfile(member) if member.isfile() else None)
+
+            # No assembled data found, so the unassembled members are kept
+            for member, spool in held:
+                tar_out.addfile(member, spool if member.isfile() else None)
+            tar_out.close()
+        finally:
+            for member, spool in held:
+                spool.close()
+            tar_in.close()
+            pigz_c.stdin.close()
+            ret = pigz_c.wait()
+
+        if not ret == 0:
+            raise subprocess.CalledProcessError(ret, self.codec.args()[0])
+
+
+class RateController(object):
+    """
+    Adaptive rate control shared by all requests to JGI and IMG. A token bucket limits the request rate and a
+    concurrency limit caps the requests waiting for a response. Both ramp up additively while responses are healthy
+    and are halved on throttling (429, 5xx or dropped connections), after which the request is retried with
+    exponential backoff or as told by Retry-After.
+    """
+
+    # Attempts per request before giving up on throttling
+    RETRIES = 6
+    # Upper bound of the backoff in seconds
+    MAX_BACKOFF = 300
+    # Seconds within which further throttled responses count as the same throttling event
+    DECREASE_INTERVAL = 1
+
+    def __init__(self, rate, max_rate, max_concurrency):
+        self.rate = float(rate)
+        self.min_rate = min(1.0, self.rate)
+        self.max_rate = float(max_rate)
+        self.limit = float(max_concurrency)
+        self.max_limit = float(max_concurrency)
+        self.tokens = 1.0
+        self.in_flight = 0
+        self.last_refill = time.time()
+        self.last_decrease = 0
+        self.cond = threading.Condition()
+
+    def is_throttled(self, r):
+        return r.status_code == 429 or r.status_code >= 500
+
+    def acquire(self):
+        with self.cond:
+            while True:
+                now = time.time()
+                # Burst of at most one second worth of requests
+                self.tokens = min(max(1.0, self.rate), self.tokens + (now - self.last_refill) * self.rate)
+                self.last_refill = now
+                if self.tokens >= 1 and self.in_flight < int(self.limit):
+                    self.tokens -= 1
+                    self.in_flight += 1
+                    return
+                self.cond.wait(max(0.01, (1 - self.tokens) / self.rate))
+
+    def release(self, throttled):
+        with self.cond:
+            self.in_flight -= 1
+            if throttled:
+                if time.time() - self.last_decrease > self.DECREASE_INTERVAL:
+                    self.last_decrease = time.time()
+                    self.rate = max(self.min_rate, self.rate / 2)
+                    self.limit = max(1.0, self.limit / 2)
+                    print("THROTTLED: %.1f requests/s, %i concurrent" % (self.rate, int(self.limit)))
+            else:
+                self.rate = min(self.max_rate, self.rate + 1 / self.rate)
+                self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            self.cond.notify_all()
+
+    def backoff(self, attempt, r=None):
+        delay = min(self.MAX_BACKOFF, 2 ** attempt) * (1 + random.random())
+        if r is not None and r.headers.get("Retry-After", "").isdigit():
+            delay = int(r.headers["Retry-After"])
+        time.sleep(delay)
+
+
+class JGISession(object):
+    """
+    Keep-alive HTTP session shared by all XML and download lanes. It is built from the JGI SSO cookies and its
+    connection pools are sized from the connection limit, so every lane reuses an open connection instead of
+    performing a new TCP/TLS handshake per request.
+    """
+
+    # Distinct hosts talked to: genome.jgi.doe.gov (http and https) and img.jgi.doe.gov
+    POOL_HOSTS = 4
+
+    def __init__(self, cookies, con_limit, rate=None, telemetry=None):
+        self.con_limit = con_limit
+        self.rate = rate
+        self.telemetry = telemetry
+        self.session = requests.Session()
+        self.session.cookies.update(cookies)
+
+        adapter = HTTPAdapter(pool_connections=self.POOL_HOSTS, pool_maxsize=con_limit)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+        # Connections not held by any lane. Lanes hold one per item, segmented downloads take extra ones only if
+        # they are free, so the total stays within the connection limit even if more lanes than that are running.
+        self.spare = con_limit
+        self.available = threading.Condition()
+
+    def claim(self, items):
+        """
+        Yields the items of a lane, holding one connection of the budget while each item is processed.
+        """
+        for item in items:
+            with self.available:
+                while self.spare == 0:
+                    self.available.wait()
+                self.spare -= 1
+            try:
+                yield item
+            finally:
+                self.release_connections(1)
+
+    def acquire_connections(self, n):
+        """
+        Takes up to n connections from the budget without blocking and returns how many were taken.
+        """
+        with self.available:
+            n = min(n, self.spare)
+            self.spare -= n
+            return n
+
+    def release_connections(self, n):
+        with self.available:
+            self.spare += n
+            self.available.notify_all()
+
+    def get(self, url, **kwargs):
+        if not self.telemetry:
+            return self.retry(url, **kwargs)
+
+        start = time.time()
+        try:
+            r = self.retry(url, **kwargs)
+        except requests.exceptions.RequestException:
+            self.telemetry.event("request", url=url, status=None, seconds=time.time() - start)
+            raise
+        # Streamed bodies are not read yet, they are accounted for by their transfer
+        received = None if kwargs.get("stream") else len(r.content)
+        self.telemetry.event("request", url=url, status=r.status_code, seconds=time.time() - start,
+                             received=received)
+        return r
+
+    def retry(self, url, **kwargs):
+        if not self.rate:
+            return self.session.get(url, **kwargs)
+
+        attempt = 0
+        while True:
+            self.rate.acquire()
+            # The slot is given back whatever the request raises, lanes would block on leaked slots otherwise
+            r = None
+            throttled = False
+            try:
+                r = self.session.get(url, **kwargs)
+                throttled = self.rate.is_throttled(r)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout,
+                    requests.exceptions.ChunkedEncodingError):
+                # Dropped connection or a body cut off mid-read
+                throttled = True
+                if attempt + 1 >= self.rate.RETRIES:
+                    raise
+            finally:
+                self.rate.release(throttled)
+
+            if r is None:
+                attempt += 1
+                self.rate.backoff(attempt)
+                continue
+            if not throttled or attempt + 1 >= self.rate.RETRIES:
+                return r
+            r.close()
+            attempt += 1
+            print("RETRYING: %s (status %i, attempt %i)" % (url, r.status_code, attempt))
+            self.rate.backoff(attempt, r)
+
+
+class XMLCache(object):
+    """
+    Persistent on-disk cache of directory XMLs, keyed by IMG_<oid> or proj_<project id>. Next to every descriptor
+    its URL, ETag, Last-Modified and fetch time are stored. Within the TTL a cached descriptor is used without any
+    request, afterwards it is revalidated by a conditional request, so an unchanged descriptor only costs a 304.
+    """
+
+    def __init__(self, cache_dir, ttl):
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.ttl = ttl
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+
+    def write_atomic(self, path, content):
+        outFile = open(path + ".tmp", "w")
+        outFile.write(content)
+        outFile.close()
+        os.rename(path + ".tmp", path)
+
+    def get(self, session, key, url=None):
+        """
+        Returns the directory XML for key (or None) and the response of the request made for it (None, if served
+        from the cache). Without url, the URL the descriptor was fetched from before is used, if any.
+        """
+        xml_path = os.path.join(self.cache_dir, "%s.xml" % (key))
+        meta_path = os.path.join(self.cache_dir, "%s.json" % (key))
+
+        meta = None
+        headers = {}
+        if os.path.exists(meta_path) and os.path.exists(xml_path):
+            inFile = open(meta_path)
+            meta = json.load(inFile)
+            inFile.close()
+            if url is None:
+                url = meta["url"]
+            if time.time() - meta["fetched"] < self.ttl:
+                inFile = open(xml_path)
+                content = inFile.read()
+                inFile.close()
+                return content, None
+            if meta["etag"]:
+                headers["If-None-Match"] = meta["etag"]
+            if meta["last_modified"]:
+                headers["If-Modified-Since"] = meta["last_modified"]
+        elif url is None:
+            return None, None
+
+        r = session.get(url, headers=headers)
+        if r.status_code == 304 and meta:
+            meta["fetched"] = time.time()
+            self.write_atomic(meta_path, json.dumps(meta))
+            inFile = open(xml_path)
+            content = inFile.read()
+            inFile.close()
+            return content, r
+        if r.headers.get("Content-Type") == "application/xml":
+            self.write_atomic(xml_path, r.content)
+            self.write_atomic(meta_path, json.dumps({"url": url, "etag": r.headers.get("ETag"),
+                                                     "last_modified": r.headers.get("Last-Modified"),
+                                                     "fetched": time.time()}))
+            return r.content, r
+        return None, r
+
+
+def xml_file_size(f_):
+    """
+    Returns the size in bytes of a file entry of a directory XML, 0 if unknown.
+    """
+    if "sizeInBytes" in f_.attrib:
+        return int(f_.attrib["sizeInBytes"])
+    # Human readable, e.g. "1.3 GB"
+    units = {"B": 1, "KB": 1024, "MB": 1024 ** 2, "GB": 1024 ** 3, "TB": 1024 ** 4}
+    size = f_.attrib.get("size", "").split()
+    try:
+        return int(float(size[0]) * units.get(size[1].upper() if len(size) > 1 else "B", 1))
+    except (IndexError, ValueError):
+        return 0
+
+
+def oid_bundle_url(xml_path, oid):
+    """
+    Returns URL and size of the download bundle (or alternatively <oid>.tar.gz) listed in the directory XML of an
+    OID, an empty URL if there is none and None if the file is no XML at all.
+    """
+    if not magic.from_file(xml_path, mime=True) == "application/xml":
+        return None
+    print("Parsing file %s" % (os.path.basename(xml_path)))
+    root = etree.parse(xml_path)
+    files_ = root.findall(".//file[@url]")
+    url = []
+    bundle = None
+    for f_ in files_:
+        if f_.attrib["filename"] == "download_bundle.tar.gz":
+            bundle = f_
+    if bundle is not None:
+        url.append(bundle)
+    else:
+        for f_ in files_:
+            if f_.attrib["filename"] == "%s.tar.gz" % (oid):
+                url.append(f_)
+    if not len(url) == 0:
+        return url[0].attrib["url"], xml_file_size(url[0])
+    print("XML description, but no alternative .tar.gz available for %s" % (oid))
+    return "", 0
+
+
+def project_bundle_url(xml_path, oid):
+    """
+    Returns URL and size of <oid>.tar.gz listed in the directory XML of the project an OID belongs to, an empty URL
+    if there is none and None if the file is no XML at all.
+    """
+    if not magic.from_file(xml_path, mime=True) == "application/xml":
+        return None
+    print("Parsing file %s" % (os.path.basename(xml_path)))
+    root = etree.parse(xml_path)
+    files_ = root.findall(".//file[@url]")
+    for f_ in files_:
+        if f_.attrib["filename"] == "%s.tar.gz" % (oid):
+            return f_.attrib["url"], xml_file_size(f_)
+    print("XML description, but no alternative .tar.gz available for %s" % (oid))
+    return "", 0
+
+
+def is_selected(filename, include, exclude, oid=None):
+    """
+    True if filename matches one of the include patterns (any if there are none) and none of the exclude patterns.
+    With oid, it also has to be named after that OID, as a project directory also lists the files of its other genomes.
+    """
+    if oid and not filename.startswith(oid):
+        return False
+    if include and not any(fnmatch.fnmatch(filename, pattern) for pattern in include):
+        return False
+    return not any(fnmatch.fnmatch(filename, pattern) for pattern in exclude)
+
+
+def parse_directory_xml(xml_path):
+    """
+    Catalog worker, runs in a process of the pool. Returns the name of a directory XML and the (filename, url, size,
+    timestamp, md5) of all files listed in it, None instead of the files if it is no XML at all. The XML is parsed
+    incrementally and every element is freed right after reading, so memory stays flat even for huge projects.
+    """
+    name = os.path.basename(xml_path)
+    if not magic.from_file(xml_path, mime=True) == "application/xml":
+        return name, None
+    entries = []
+    for event, f_ in etree.iterparse(xml_path, events=("end",), tag="file"):
+        if "url" in f_.attrib:
+            entries.append((f_.attrib.get("filename", ""), f_.attrib["url"], xml_file_size(f_),
+                            f_.attrib.get("timestamp"), f_.attrib.get("md5")))
+        f_.clear()
+        while f_.getprevious() is not None:
+            del f_.getparent()[0]
+    return name, entries
+
+
+class Catalog(object):
+    """
+    SQLite index of all files listed in the directory XMLs: <oid>.xml (kind oid) and proj_<oid>.xml (kind proj).
+    Only descriptions that are new or changed since the last update are parsed, in parallel by a process pool, and
+    stored by the parent as single writer. Download planning reads bundles and file listings from here instead of
+    parsing XMLs; the file can be queried directly for later carts, e.g.
+    sqlite3 catalog.sqlite "SELECT oid, filename, size FROM files WHERE filename LIKE '%.ko.tab.txt'"
+    sqlite3 catalog.sqlite "SELECT oid, filename, size FROM files WHERE project = '1234567'"
+    The project of an OID is taken from the genome cart (--project-field) and kept for later runs.
+    """
+
+    SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS xmls (name TEXT PRIMARY KEY, oid TEXT, kind TEXT, mtime REAL, size INTEGER, "
+        "valid INTEGER)",
+        "CREATE TABLE IF NOT EXISTS files (xml TEXT, oid TEXT, kind TEXT, filename TEXT, url TEXT, size INTEGER, "
+        "timestamp TEXT, md5 TEXT, project TEXT)",
+        "CREATE INDEX IF NOT EXISTS files_oid ON files (oid, kind)",
+        "CREATE INDEX IF NOT EXISTS files_url ON files (url)",
+    )
+    # Created after the columns of older catalogs are brought up to date
+    INDEXES = (
+        "CREATE INDEX IF NOT EXISTS files_project ON files (project)",
+    )
+
+    def __init__(self, path):
+        self.path = path
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.text_factory = str
+        for statement in self.SCHEMA:
+            self.db.execute(statement)
+        columns = [row[1] for row in self.db.execute("PRAGMA table_info(files)")]
+        if "project" not in columns:
+            # Catalog of an earlier release, projects are filled in by the next update
+            self.db.execute("ALTER TABLE files ADD COLUMN project TEXT")
+        for statement in self.INDEXES:
+            self.db.execute(statement)
+        self.db.commit()
+
+    def update(self, xml_dir, processes, projects=None):
+        """
+        Brings the catalog in line with the XMLs of xml_dir. projects maps OIDs of the cart to their JGI project.
+        """
+        projects = projects or {}
+        known = dict((row[0], row[1:]) for row in self.db.execute("SELECT name, mtime, size FROM xmls"))
+        stats = {}
+        for name in os.listdir(xml_dir):
+            if name.endswith(".xml"):
+                st = os.stat(os.path.join(xml_dir, name))
+                stats[name] = (st.st_mtime, st.st_size)
+        for name in set(known) - set(stats):
+            self.remove(name)
+        changed = [name for name in stats if not known.get(name) == stats[name]]
+        print("Cataloging %i of %i XML descriptions" % (len(changed), len(stats)))
+        # Unchanged descriptions of cart OIDs whose project is new or differs
+        self.db.executemany("UPDATE files SET project = ? WHERE oid = ? AND project IS NOT ?",
+                            [(project, oid, project) for oid, project in projects.iteritems()])
+        self.db.commit()
+        if not changed:
+            return
+
+        pool = multiprocessing.Pool(processes)
+        try:
+            paths = [os.path.join(xml_dir, name) for name in changed]
+            for n, (name, entries) in enumerate(pool.imap_unordered(parse_directory_xml, paths, chunksize=16)):
+                self.remove(name)
+                if name.startswith("proj_"):
+                    oid, kind = name[len("proj_"):-len(".xml")], "proj"
+                else:
+                    oid, kind = name[:-len(".xml")], "oid"
+                self.db.execute("INSERT INTO xmls VALUES (?, ?, ?, ?, ?, ?)",
+                                (name, oid, kind) + stats[name] + (entries is not None,))
+                self.db.executemany("INSERT INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                    [(name, oid, kind) + entry + (projects.get(oid),) for entry in entries or []])
+                if n % 1000 == 999:
+                    self.db.commit()
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+            self.db.commit()
+
+    def remove(self, name):
+        self.db.execute("DELETE FROM xmls WHERE name = ?", (name,))
+        self.db.execute("DELETE FROM files WHERE xml = ?", (name,))
+
+    def oids(self, kind):
+        """
+        OIDs with a valid description of the given kind.
+        """
+        return set(row[0] for row in self.db.execute("SELECT oid FROM xmls WHERE kind = ? AND valid", (kind,)))
+
+    def listing(self, oid, kind):
+        """
+        (filename, url, size) of the files in a description, in document order.
+        """
+        return self.db.execute("SELECT filename, url, size FROM files WHERE oid = ? AND kind = ? ORDER BY rowid",
+                               (oid, kind)).fetchall()
+
+    def bundle(self, oid, kind):
+        """
+        Same as oid_bundle_url or project_bundle_url, but from the catalog.
+        """
+        valid = self.db.execute("SELECT valid FROM xmls WHERE oid = ? AND kind = ?", (oid, kind)).fetchone()
+        if not valid or not valid[0]:
+            return None
+        files_ = self.listing(oid, kind)
+        names = ["%s.tar.gz" % (oid)] if kind == "proj" else ["download_bundle.tar.gz", "%s.tar.gz" % (oid)]
+        for name in names:
+            for filename, url, size in files_:
+                if filename == name:
+                    return url, size
+        print("XML description, but no alternative .tar.gz available for %s" % (oid))
+        return "", 0
+
+    def checksums(self, base_url):
+        """
+        Full download URL -> MD5 of all listed files with a checksum.
+        """
+        return dict(("%s/%s" % (base_url, url), md5) for url, md5 in
+                    self.db.execute("SELECT url, md5 FROM files WHERE md5 IS NOT NULL AND md5 != ''"))
+
+    def files(self, oid, include, exclude, projects=True):
+        """
+        Returns (filename, url, size) of the selected files listed in the OID and (optionally) project description of
+        an OID.
+        """
+        entries = {}
+        for kind in ("proj", "oid") if projects else ("oid",):
+            for filename, url, size in self.listing(oid, kind):
+                filename = os.path.basename(filename)
+                if is_selected(filename, include, exclude, oid if kind == "proj" else None):
+                    entries[filename] = (filename, url, size)
+        return sorted(entries.values())
+
+
+class TmpSpace(object):
+    """
+    Admission control for downloads into the tmp dir. A download of known size only starts if the free space of the
+    tmp dir covers it together with all downloads in flight; otherwise the lane waits until others are done (or the
+    shrinking lanes freed space). A bundle larger than the free space of an otherwise idle tmp dir is refused.
+    Bytes already written by downloads in flight are counted twice, which errs on the safe side.
+    """
+
+    # Bytes always kept free in the tmp dir
+    MARGIN = 1024 ** 3
+    # Seconds between re-checks of the free space while waiting
+    POLL_INTERVAL = 30
+
+    def __init__(self, path):
+        self.path = path
+        self.in_flight = 0
+        self.cond = threading.Condition()
+
+    def free(self):
+        st = os.statvfs(self.path)
+        return st.f_bavail * st.f_frsize - self.MARGIN
+
+    def claim(self, items):
+        """
+        Yields the (key, url, size) items of a lane once their size fits into the tmp dir, skipping those that never
+        will.
+        """
+        for item in items:
+            size = item[2]
+            if not size:
+                # Unknown size, nothing to account for
+                yield item
+                continue
+            with self.cond:
+                while self.in_flight > 0 and self.in_flight + size > self.free():
+                    self.cond.wait(self.POLL_INTERVAL)
+                if size > self.free():
+                    print("NOT ENOUGH SPACE: %s needs %i bytes, %s has %i free" % (item[0], size, self.path,
+                                                                                  self.free()))
+                    continue
+                self.in_flight += size
+            try:
+                yield item
+            finally:
+                with self.cond:
+                    self.in_flight -= size
+                    self.cond.notify_all()
+
+
+class LaneQueue(object):
+    """
+    Work queue shared by several lanes. Instead of striping the work statically across the lanes up front, every
+    lane pulls the next item as soon as it is free. Iterating blocks until an item is available and stops once the
+    queue is closed and drained. With a maxsize, putting blocks while the queue is full.
+    """
+
+    # Seconds a waiting lane sleeps before re-checking whether the queue was closed
+    POLL_INTERVAL = 1
+
+    def __init__(self, items=None, maxsize=0):
+        self.queue = Queue.Queue(maxsize)
+        self.closed = False
+        if items:
+            for item in items:
+                self.queue.put(item)
+
+    def __len__(self):
+        return self.queue.qsize()
+
+    def __iter__(self):
+        while True:
+            # Read the flag before polling: if it was already closed, no item can arrive after an empty poll.
+            closed = self.closed
+            try:
+                item = self.queue.get(timeout=self.POLL_INTERVAL)
+            except Queue.Empty:
+                if closed:
+                    return
+                continue
+            yield item
+
+    def put(self, item):
+        self.queue.put(item)
+
+    def close(self):
+        self.closed = True
+
+
+class XMLFeed(object):
+    """
+    Hands the bundle URL of every directory XML to the download lanes as soon as the XML is written, so downloads
+    run while the XML retrieval is still going on. OID descriptors feed the oid queue, project descriptors the
+    project queue. Every descriptor is fed only once.
+    """
+
+    def __init__(self, xml_dir):
+        self.xml_dir = xml_dir
+        self.oid_queue = LaneQueue()
+        self.proj_queue = LaneQueue()
+        self.fed = set()
+        self.lock = threading.Lock()
+
+    def is_new(self, filename):
+        with self.lock:
+            if filename in self.fed:
+                return False
+            self.fed.add(filename)
+            return True
+
+    def feed_oid(self, oid):
+        filename = "%s.xml" % (oid)
+        if self.is_new(filename):
+            bundle = oid_bundle_url(os.path.join(self.xml_dir, filename), oid)
+            if bundle is not None:
+                self.oid_queue.put((oid,) + bundle)
+
+    def feed_proj(self, oid):
+        filename = "proj_%s.xml" % (oid)
+        if self.is_new(filename):
+            bundle = project_bundle_url(os.path.join(self.xml_dir, filename), oid)
+            if bundle is not None:
+                self.proj_queue.put((oid,) + bundle)
+
+    def close(self, oids):
+        """
+        Feeds all descriptors of the outstanding OIDs of the cart found in the XML directory that were not fed yet,
+        e.g. given by --xml-dir or written by a previous run, and closes both queues afterwards.
+        """
+        xmls = set(os.listdir(self.xml_dir))
+        for oid in oids:
+            if "%s.xml" % (oid[0]) in xmls:
+                self.feed_oid(oid[0])
+        self.oid_queue.close()
+
+        for oid in oids:
+            if "proj_%s.xml" % (oid[0]) in xmls:
+                self.feed_proj(oid[0])
+        self.proj_queue.close()
+
 
 def parse_arguments():
     parser = argparse.ArgumentParser("Downloads automatically (meta)genomes from JGI genome portal in parallel.")
@@ -48,7 +1282,8 @@ def parse_arguments():
     parser.add_argument("--no-header", dest='skip_header', help="Set, if no header line is contained in genome cart",
                         required=False, default=True, action='store_false')
 
-    parser.add_argument("--finished", dest='finished', help="Genome cart like file with finished IMG taxon OIDs",
+    parser.add_argument("--finished", dest='finished',
+                        help="Genome cart like file with finished IMG taxon OIDs. These and all OIDs recorded in Downloads/manifest.tsv of the final dir are skipped.",
                         required=False)
     parser.add_argument("-t", "--tmp-dir", dest='tmp_dir', help="TMP dir to use. Default: %s" % os.path.abspath('.'),
                         default=None, required=False)
@@ -62,15 +1297,61 @@ def parse_arguments():
     parser.add_argument("--is-dry-run", dest='dry_run', help="Check workflow without execution.", default=False,
                         action='store_true', required=False)
 
+    parser.add_argument("--plan", dest='plan',
+                        help="Retrieve (or take cached) XML descriptions and report bytes per lane, projected wall time from the throughput of earlier runs, peak tmp space and OIDs without bundle, but download nothing.",
+                        default=False, action='store_true', required=False)
+
     parser.add_argument("-d", "--download-bundled", dest='download', help="Download bundled data", default=False,
                         action='store_true', required=False)
     parser.add_argument("-c", "--connection-limit", dest='con_limit', help="Connection limit. Default: %i" % (5),
                         type=int, default=5, required=False)
 
+    parser.add_argument("--segments", dest='segments',
+                        help="Fetch bundles above the segment threshold as this many concurrent byte ranges. Segments beyond the first only use connections left free by the connection limit. Default: %i (off)" % (1),
+                        type=int, default=1, required=False)
+    parser.add_argument("--segment-threshold", dest='segment_threshold',
+                        help="Minimal bundle size in MB for segmented downloads. Default: %i" % (2048), type=int,
+                        default=2048, required=False)
+    parser.add_argument("--dynamic-dispatch", dest='dynamic',
+                        help="Lanes pull the next OID or URL from a shared queue as soon as they are free, instead of getting a fixed share of the genome cart assigned up front.",
+                        default=False, action='store_true', required=False)
+
+    parser.add_argument("--pipelined", dest='pipelined',
+                        help="Start downloading as soon as the first XML descriptions are retrieved instead of waiting for all of them. Project lookups run alongside the OID downloads. Implies --dynamic-dispatch.",
+                        default=False, action='store_true', required=False)
+
+    parser.add_argument("--request-rate", dest='request_rate',
+                        help="Initial requests per second to JGI/IMG. The rate is raised while responses are healthy and halved with backoff and retry on throttling (429, 5xx). Default: %i" % (5),
+                        type=float, default=5, required=False)
+    parser.add_argument("--max-request-rate", dest='max_request_rate',
+                        help="Upper bound for the adaptive request rate. Default: %i" % (50), type=float, default=50,
+                        required=False)
+
     parser.add_argument("-x", "--xml-dir", dest='xml_dir',
                         help="Directory to already downloaded XML descriptions. Use this, if you want to avoid being kicked by the IMG systems and already downloaded XML descriptions on (meta)genomes!",
                         default=None, type=str, required=False)
 
+    parser.add_argument("--xml-cache", dest='xml_cache',
+                        help="Directory of a persistent XML description cache shared between runs. Descriptions are revalidated with conditional requests once older than --xml-cache-ttl.",
+                        default=None, type=str, required=False)
+    parser.add_argument("--xml-cache-ttl", dest='xml_cache_ttl',
+                        help="Hours a cached XML description is used without asking JGI whether it changed. Default: %i" % (24),
+                        default=24, type=float, required=False)
+
+    parser.add_argument("--include", dest='include',
+                        help="With -d, download only the files of the XML listings matching these comma separated patterns (e.g. '*.cog.tab.txt,*.ko.tab.txt') into Downloads/<oid>/ instead of the whole bundle.",
+                        default=None, type=str, required=False)
+    parser.add_argument("--exclude", dest='exclude',
+                        help="With -d, download all files of the XML listings except the ones matching these comma separated patterns into Downloads/<oid>/ instead of the whole bundle. Can be combined with --include.",
+                        default=None, type=str, required=False)
+
+    parser.add_argument("--catalog", dest='catalog',
+                        help="SQLite catalog of all files listed in the XML descriptions, updated before downloading and used for planning. Default: <final dir>/catalog.sqlite",
+                        default=None, type=str, required=False)
+    parser.add_argument("--catalog-workers", dest='catalog_workers',
+                        help="Processes parsing XML descriptions into the catalog. Default: %i" % (4), type=int,
+                        default=4, required=False)
+
     parser.add_argument("-e", "--exclude-faa-fna-gff", dest='nofaafnagff',
                         help="Exclude directly fna, faa and gff files from .tar.gz", default=False, action='store_true',
                         required=False)
@@ -81,6 +1362,31 @@ def parse_arguments():
     parser.add_argument("-k", "--keep-unassembled-if-no-assembled", dest="keep_unassembled",
                         help="If -u set and only unassembled data is found (no assembled data is contained), these files are NOT removed (but fna, faa and gff are)!",
                         required=False, default=False, action='store_true')
+    parser.add_argument("--stream-filter", dest='stream_filter',
+                        help="With -e, shrink bundles while they are downloaded, reading each archive once and without tmp copy. Such downloads are not resumable and not segmented.",
+                        default=False, action='store_true', required=False)
+    parser.add_argument("--verify-workers", dest='verify_workers',
+                        help="Stored bundles tested for gzip and tar integrity in parallel before they are recorded as finished, corrupt ones are listed in Downloads/corrupt.tsv and downloaded again by the next run. Downloads are also compared with the MD5 listed in their XML description, except under --pipelined, where no catalog is built, under --stream-filter, where bundles are filtered while they arrive and never stored whole, and for bundles found through the IMG taxon page, which have no listed MD5. 0 disables the integrity test. Default: %i" % (2),
+                        type=int, default=2, required=False)
+    parser.add_argument("--shrink-workers", dest='shrink_workers',
+                        help="Amount of bundles shrinked (-e) in parallel, independent of the connection limit. Default: %i" % (2),
+                        type=int, default=2, required=False)
+    parser.add_argument("--shrink-threads", dest='shrink_threads',
+                        help="Threads of the codec per shrinked bundle. Default: available cores divided by --shrink-workers (by -c with --stream-filter)",
+                        type=int, default=None, required=False)
+    parser.add_argument("--codec", dest='codec',
+                        help="Recompression of shrinked bundles: gzip (pigz, .tar.gz), zstd (.tar.zst) or store (uncompressed .tar). Default: %s" % ("gzip"),
+                        choices=sorted(Codec.CODECS), default="gzip", required=False)
+    parser.add_argument("--level", dest='level',
+                        help="Compression level of the codec. Default: %s" % (", ".join(
+                            "%s %i" % (name, codec[1]) for name, codec in sorted(Codec.CODECS.items()) if codec[1])),
+                        type=int, default=None, required=False)
+    parser.add_argument("--telemetry", dest='telemetry',
+                        help="Append JSON lines with latency, bytes and duration of every HTTP request, transfer and shrinking step to this file and print a summary of the run at its end.",
+                        default=None, type=str, required=False)
+    parser.add_argument("--portal-url", dest='portal_url',
+                        help="Base URL used instead of genome.jgi.doe.gov, img.jgi.doe.gov and signon.jgi.doe.gov, e.g. http://127.0.0.1:8080 of mock_jgi_portal.py for offline tests and benchmarks.",
+                        default=None, type=str, required=False)
     # parser.add_argument("--new-cluster", dest='new_cluster', help="Use the new cluster engine (OGE)", required=False, default=False, action='store_true')
 
     args = parser.parse_args()
@@ -89,32 +1395,51 @@ def parse_arguments():
 
 
 class GatherXMLWorkflow(WorkflowRunner):
-    def __init__(self, cur_ids, project_field, dest_dir, cookies):
+    def __init__(self, cur_ids, project_field, dest_dir, session, feed=None, cache=None):
         self.cur_ids = cur_ids
         self.project_field = project_field
         self.dest_dir = dest_dir
-        self.cookies = cookies
+        self.session = session
+        self.feed = feed
+        self.cache = cache
+
+    def get_directory(self, key, url):
+        """
+        Returns the directory XML (or None) and the last response. Goes through the XML cache, if one is used.
+        """
+        if self.cache:
+            return self.cache.get(self.session, key, url)
+        if url is None:
+            return None, None
+        r = self.session.get(url)
+        if r.headers["Content-Type"] == "application/xml":
+            return r.content, r
+        return None, r
 
     def workflow(self):
-        for i in self.cur_ids:
-            r = requests.get('http://genome.jgi.doe.gov/ext-api/downloads/get-directory?organism=IMG_%s' % (i[0]),
-                             cookies=self.cookies)
-            if r.headers["Content-Type"] == "application/xml":
-                outFile = open(os.path.join(self.dest_dir, "XML", "%s.xml" % (i[0])), "w")
-                outFile.write(r.content)
-                outFile.close()
+        for i in self.session.claim(self.cur_ids):
+            xml, r = self.get_directory(
+                "IMG_%s" % (i[0]), '%s/ext-api/downloads/get-directory?organism=IMG_%s' % (PORTAL_URL, i[0]))
+            if xml is not None:
+                write_descriptor(os.path.join(self.dest_dir, "XML", "%s.xml" % (i[0])), xml)
+                if self.feed:
+                    self.feed.feed_oid(i[0])
             else:
                 if not self.project_field == -1:
                     # GO VIA PROJECT ID -- http://genome.jgi.doe.gov/lookup?keyName=jgiProjectId&keyValue=407984
-                    r = requests.get('http://genome.jgi.doe.gov/lookup?keyName=jgiProjectId&keyValue=%s' % (i[1]),
-                                     cookies=self.cookies)
-                    url = r.url.split("=")[-1]
-                    r = requests.get('http://genome.jgi.doe.gov/ext-api/downloads/get-directory?organism=%s' % (url),
-                                     cookies=self.cookies)
-                    if r.headers["Content-Type"] == "application/xml":
-                        outFile = open(os.path.join(self.dest_dir, "XML", "proj_%s.xml" % (i[0])), "w")
-                        outFile.write(r.content)
-                        outFile.close()
+                    # A cached project descriptor spares the lookup as well
+                    xml, r = self.get_directory("proj_%s" % (i[1]), None)
+                    if xml is None:
+                        r = self.session.get(
+                            '%s/lookup?keyName=jgiProjectId&keyValue=%s' % (PORTAL_URL, i[1]))
+                        url = r.url.split("=")[-1]
+                        xml, r = self.get_directory(
+                            "proj_%s" % (i[1]),
+                            '%s/ext-api/downloads/get-directory?organism=%s' % (PORTAL_URL, url))
+                    if xml is not None:
+                        write_descriptor(os.path.join(self.dest_dir, "XML", "proj_%s.xml" % (i[0])), xml)
+                        if self.feed:
+                            self.feed.feed_proj(i[0])
                     else:
                         outFile = open(os.path.join(self.dest_dir, "XML", "ERR_%s.err" % (i[0])), "w")
                         outFile.write(r.content)
@@ -126,15 +1451,24 @@ class GatherXMLWorkflow(WorkflowRunner):
 
 
 class GatherDownload(WorkflowRunner):
-    def __init__(self, ids, cookies, dest_dir, tmp_dir, is_oid, omit, unassembled, keep_unassembled):
+
+    # Attempts to resume a dropped bundle transfer within the same run
+    RESUME_ATTEMPTS = 3
+
+    def __init__(self, ids, session, dest_dir, tmp_dir, is_oid, shrink_queue, segments, segment_threshold,
+                 tar_filter=None, space=None, artifacts=None, transfers=None):
         self.ids = ids
-        self.cookies = cookies
+        self.session = session
         self.dest_dir = dest_dir
         self.tmp_dir = tmp_dir
         self.is_oid = is_oid
-        self.omit = omit
-        self.unassembled = unassembled
-        self.keep_unassembled = keep_unassembled
+        self.shrink_queue = shrink_queue
+        self.tar_filter = tar_filter
+        self.space = space
+        self.artifacts = artifacts
+        self.transfers = transfers
+        self.n_segments = segments
+        self.segment_threshold = segment_threshold * 1024 * 1024
 
     def workflow(self):
         self.dest_dir = os.path.join(self.dest_dir, "Downloads")
@@ -142,108 +1476,407 @@ class GatherDownload(WorkflowRunner):
             self.tmp_dir = self.dest_dir
 
         if self.is_oid:
-            for i in self.ids:
-                r = requests.get('http://genome.jgi.doe.gov/IMG_%s/download/download_bundle.tar.gz' % (i),
-                                 cookies=self.cookies)
+            for i in self.session.claim(self.ids):
+                r, partial = self.fetch('%s/IMG_%s/download/download_bundle.tar.gz' % (PORTAL_URL, i),
+                                        i, "oid")
                 if not r.headers["Content-Type"] == "application/x-gzip":
-                    outFile = open(os.path.join(self.dest_dir, "ERROR_%s.html" % (i)), "w")
-                    outFile.write(r.content)
-                    outFile.close()
+                    write_response(r, os.path.join(self.dest_dir, "ERROR_%s.html" % (i)))
                 else:
-                    if self.omit:
-                        self.post_process_tar(r.content, i, self.tmp_dir, self.dest_dir, self.unassembled,
-                                              self.keep_unassembled, "oid")
-                    else:
-                        print("WRITING FILE: %s" % (i))
-                        outFile = open(os.path.join(self.dest_dir, "%s.tar.gz" % (i)), "w")
-                        outFile.write(r.content)
-                        outFile.close()
+                    self.store_bundle(r, partial, i, "oid", "%s.tar.gz" % (i))
 
         else:
-            for key in self.ids.keys():
-                r = requests.get('http://genome.jgi.doe.gov/%s' % (self.ids[key]), cookies=self.cookies)
-                if not r.headers["Content-Type"] == "application/x-gzip" and not r.headers[
-                    "Content-Type"] == "application/octet-stream":
-
-                    r = requests.get(
-                        "https://img.jgi.doe.gov/cgi-bin/m/main.cgi?section=TaxonDetail&page=taxonDetail&taxon_oid=%s" % (
-                            key), cookies=self.cookies)
-                    root = etree.HTML(r.content)
-                    refs = root.xpath(
-                        ".//a[contains(@href, 'http://genome.jgi.doe.gov/lookup?keyName=jgiProjectId&keyValue=')]")
-                    if len(refs) > 0:
-                        proj_id = refs[0].attrib["href"].strip().split("=")[-1]
-
-                        r = requests.get(
-                            'http://genome.jgi.doe.gov/lookup?keyName=jgiProjectId&keyValue=%s' % (proj_id),
-                            cookies=self.cookies)
-                        url = r.url.split("=")[-1]
-                        r = requests.get(
-                            'http://genome.jgi.doe.gov/ext-api/downloads/get-directory?organism=%s' % (url),
-                            cookies=self.cookies)
-                        if r.headers["Content-Type"] == "application/xml":
-                            root = etree.XML(r.content)
-                            files_ = root.findall(".//file[@url]")
-                            url = ""
-                            for f_ in files_:
-                                if f_.attrib["filename"] == "download_bundle.tar.gz":
-                                    url = f_.attrib["url"]
-                            if not url:
-                                for f_ in files_:
-                                    if f_.attrib["filename"] == "%s.tar.gz" % (key):
-                                        url = f_.attrib["url"]
-
-                            if url:
-                                r = requests.get(
-                                    'http://genome.jgi.doe.gov/%s' % (url),
-                                    cookies=self.cookies)
-                                if not r.headers["Content-Type"] == "application/x-gzip" and not r.headers[
-                                    "Content-Type"] == "application/octet-stream":
-                                    outFile = open(os.path.join(self.dest_dir, "ERROR_%s.html" % (key)), "w")
-                                    outFile.write(r.content)
-                                    outFile.close()
-                                else:
-                                    if self.omit:
-                                        self.post_process_tar(r.content, key, self.tmp_dir, self.dest_dir,
-                                                              self.unassembled,
-                                                              self.keep_unassembled, "proj2")
-                                    else:
-                                        print("WRITING FILE: %s" % (key))
-                                        outFile = open(os.path.join(self.dest_dir, "%s.tar.gz" % (key)), "w")
-                                        outFile.write(r.content)
-                                        outFile.close()
-                            else:
-                                outFile = open(os.path.join(self.dest_dir, "ERROR_%s_proj.html" % (key)), "w")
-                                outFile.write(r.content)
-                                outFile.close()
+            ids = self.ids
+            if self.space:
+                ids = self.space.claim(ids)
+            for key, url, size in self.session.claim(ids):
+                self.fetch_project_bundle('%s/%s' % (PORTAL_URL, url), key)
+
+    def fetch_project_bundle(self, url, key):
+        """
+        Fetches the bundle of the project of key, falling back to the bundle found through its IMG taxon page if the
+        portal answers with an error page. OIDs waiting for the same project bundle fall back on their own then.
+        """
+        if not self.is_owner(url, key):
+            return
+        r, partial = self.fetch(url, key, "proj")
+        if not r.headers["Content-Type"] == "application/x-gzip" and not r.headers[
+            "Content-Type"] == "application/octet-stream":
+            r.close()
+            waiting = self.artifacts.abandon(url, key) if self.artifacts else []
+            for key_ in [key] + waiting:
+                self.fetch_taxon_bundle(key_)
+        else:
+            self.store_bundle(r, partial, key, "proj", "%s_proj.tar.gz" % (key))
+
+    def fetch_taxon_bundle(self, key):
+        """
+        Looks up the JGI project of key on its IMG taxon page and fetches the bundle listed in its directory XML.
+        """
+        r = self.session.get(
+            "%s/cgi-bin/m/main.cgi?section=TaxonDetail&page=taxonDetail&taxon_oid=%s" % (IMG_URL, key))
+        root = etree.HTML(r.content)
+        refs = root.xpath(
+            ".//a[contains(@href, '%s/lookup?keyName=jgiProjectId&keyValue=')]" % (PORTAL_URL))
+        if len(refs) > 0:
+            proj_id = refs[0].attrib["href"].strip().split("=")[-1]
+
+            r = self.session.get(
+                '%s/lookup?keyName=jgiProjectId&keyValue=%s' % (PORTAL_URL, proj_id))
+            url = r.url.split("=")[-1]
+            r = self.session.get(
+                '%s/ext-api/downloads/get-directory?organism=%s' % (PORTAL_URL, url))
+            if r.headers["Content-Type"] == "application/xml":
+                root = etree.XML(r.content)
+                files_ = root.findall(".//file[@url]")
+                url = ""
+                for f_ in files_:
+                    if f_.attrib["filename"] == "download_bundle.tar.gz":
+                        url = f_.attrib["url"]
+                if not url:
+                    for f_ in files_:
+                        if f_.attrib["filename"] == "%s.tar.gz" % (key):
+                            url = f_.attrib["url"]
+
+                if url:
+                    url = '%s/%s' % (PORTAL_URL, url)
+                    if self.is_owner(url, key):
+                        r, partial = self.fetch(url, key, "proj2")
+                        if not r.headers["Content-Type"] == "application/x-gzip" and not r.headers[
+                            "Content-Type"] == "application/octet-stream":
+                            write_response(r, os.path.join(self.dest_dir, "ERROR_%s.html" % (key)))
+                            if self.artifacts:
+                                # Waiting OIDs resolved to the same bundle and stay unrecorded for the next run
+                                self.artifacts.abandon(url, key)
                         else:
-                            outFile = open(os.path.join(self.dest_dir, "ERROR_%s_proj.html" % (key)), "w")
-                            outFile.write(r.content)
-                            outFile.close()
-                    else:
-                        outFile = open(os.path.join(self.dest_dir, "ERROR_%s_proj.html" % (key)), "w")
-                        outFile.write(r.content)
-                        outFile.close()
+                            self.store_bundle(r, partial, key, "proj2", "%s.tar.gz" % (key))
                 else:
-                    if self.omit:
-                        self.post_process_tar(r.content, key, self.tmp_dir, self.dest_dir, self.unassembled,
-                                              self.keep_unassembled, "proj")
-                    else:
-                        print("WRITING FILE: %s" % (key))
-                        outFile = open(os.path.join(self.dest_dir, "%s_proj.tar.gz" % (key)), "w")
-                        outFile.write(r.content)
-                        outFile.close()
+                    outFile = open(os.path.join(self.dest_dir, "ERROR_%s_proj.html" % (key)), "w")
+                    outFile.write(r.content)
+                    outFile.close()
+            else:
+                outFile = open(os.path.join(self.dest_dir, "ERROR_%s_proj.html" % (key)), "w")
+                outFile.write(r.content)
+                outFile.close()
+        else:
+            outFile = open(os.path.join(self.dest_dir, "ERROR_%s_proj.html" % (key)), "w")
+            outFile.write(r.content)
+            outFile.close()
+
+    def is_owner(self, url, key):
+        """
+        False if another OID already fetches the bundle url, key is linked to its artifact then.
+        """
+        if not self.artifacts or url.endswith("/"):
+            return True
+        return self.artifacts.claim(url, key)
+
+    def fetch(self, url, key, suffix):
+        """
+        Requests a bundle, continuing a partial download of an earlier attempt if its journal is found.
+        """
+        # Received next to where the bundle ends up, so finishing it is a rename on the same filesystem
+        part_dir = os.path.join(self.tmp_dir if self.shrink_queue else self.dest_dir, "partial")
+        partial = PartialDownload(part_dir, "%s_%s" % (key, suffix), url)
+        r = self.session.get(url, stream=True, headers=partial.headers())
+        if r.status_code == 416:
+            # Range not satisfiable anymore, start over
+            r.close()
+            partial.received = 0
+            r = self.session.get(url, stream=True)
+        return r, partial
+
+    def receive(self, r, partial, path):
+        """
+        Writes a bundle to path, resuming the transfer from the last received byte if the connection drops.
+        """
+        start = time.time()
+        if partial.segments is None:
+            received = partial.received
+        else:
+            received = sum(segment[2] for segment in partial.segments)
+        attempt = 0
+        while True:
+            try:
+                if partial.segments is None and self.is_segmentable(r):
+                    partial.split(int(r.headers["Content-Length"]), self.n_segments)
+                if partial.segments is not None:
+                    r.close()
+                    self.receive_segmented(partial, path)
+                else:
+                    partial.write(r, path)
+                received = os.path.getsize(path) - received
+                if self.transfers:
+                    self.transfers.record(partial.name, received, time.time() - start)
+                if self.session.telemetry:
+                    self.session.telemetry.event("transfer", oid=partial.name, url=partial.url, received=received,
+                                                 seconds=time.time() - start, attempts=attempt + 1,
+                                                 segments=len(partial.segments or []))
+                return
+            except (IOError, requests.exceptions.RequestException):
+                attempt += 1
+                if attempt > self.RESUME_ATTEMPTS:
+                    raise
+                print("RESUMING FILE: %s at byte %i" % (partial.url, partial.received))
+                if partial.segments is not None:
+                    continue
+                r = self.session.get(partial.url, stream=True, headers=partial.headers())
+                if not self.is_payload(r):
+                    r.close()
+                    raise IOError("Resuming %s failed with Content-Type %s" % (
+                        partial.url, r.headers.get("Content-Type")))
+
+    def is_payload(self, r):
+        return r.headers.get("Content-Type") in PartialDownload.BUNDLE_TYPES
+
+    def is_segmentable(self, r):
+        return self.n_segments > 1 and r.status_code == 200 and r.headers.get("Accept-Ranges") == "bytes" \
+               and int(r.headers.get("Content-Length", 0)) > self.segment_threshold
+
+    def receive_segmented(self, partial, path):
+        """
+        Fetches the segments of a bundle with the lane's own connection plus any spare ones of the budget.
+        """
+        extra = self.session.acquire_connections(self.n_segments - 1)
+        try:
+            print("WRITING FILE: %s in %i segments over %i connections" % (partial.url, len(partial.segments),
+                                                                           extra + 1))
+            partial.write_segments(self.session, path, extra + 1)
+        finally:
+            self.session.release_connections(extra)
+
+    def filter_bundle(self, r, url, key, suffix):
+        """
+        Shrinks a bundle while it is downloaded. As nothing but the shrinked result is written, the transfer can not
+        be resumed; it is retried from the start instead.
+        """
+        path = os.path.join(self.dest_dir, "shrinked", "%s_%s%s" % (key, suffix, self.tar_filter.codec.suffix))
+        attempt = 0
+        while True:
+            if r is None:
+                r = self.session.get(url, stream=True)
+            r.raw.decode_content = True
+            outFile = open(path + ".tmp", "wb")
+            start = time.time()
+            try:
+                print("FILTERING FILE: %s" % (key))
+                self.tar_filter.filter(r.raw, outFile)
+                outFile.close()
+                os.rename(path + ".tmp", path)
+                if self.session.telemetry:
+                    # Compressed bytes read off the stream
+                    received = r.raw.tell()
+                    self.session.telemetry.event("filter", oid=key, url=url, received=received,
+                                                 seconds=time.time() - start, bytes_in=received,
+                                                 bytes_out=os.path.getsize(path))
+                if self.artifacts:
+                    self.artifacts.store(key, url, path)
+                return
+            except (IOError, tarfile.TarError, requests.exceptions.RequestException):
+                outFile.close()
+                os.remove(path + ".tmp")
+                attempt += 1
+                if attempt > self.RESUME_ATTEMPTS:
+                    raise
+                print("RESTARTING FILE: %s" % (url))
+            finally:
+                r.close()
+                r = None
+
+    def store_bundle(self, r, partial, key, suffix, filename):
+        """
+        Streams the bundle of a checked response either directly to its final destination or, if fna, faa and gff
+        files are omitted, to a tmp file that is handed over to the shrinking lanes or through the streaming filter.
+        """
+        if self.tar_filter:
+            if not r.status_code == 200:
+                # A ranged response of an earlier partial download, the filter needs the archive from its start
+                r.close()
+                r = None
+            self.filter_bundle(r, partial.url, key, suffix)
+        elif self.shrink_queue:
+            pre_path = os.path.join(self.tmp_dir, "pre_%s_%s.tar.gz" % (key, suffix))
+            if self.receive_verified(r, partial, key, pre_path):
+                self.shrink_queue.put((pre_path, key, suffix, partial.url))
+        else:
+            print("WRITING FILE: %s" % (key))
+            path = os.path.join(self.dest_dir, filename)
+            if self.receive_verified(r, partial, key, path) and self.artifacts:
+                self.artifacts.store(key, partial.url, path, partial.md5)
+
+    def receive_verified(self, r, partial, key, path):
+        """
+        receive() comparing the MD5 of the bundle, hashed while it streams in, with the checksum listed in its
+        directory XML. A mismatching bundle is fetched once more from scratch; returns False if it still mismatches.
+        """
+        expected = self.artifacts.checksum(partial.url) if self.artifacts else None
+        attempt = 0
+        while True:
+            self.receive(r, partial, path)
+            if not expected:
+                return True
+            if partial.md5 is None:
+                # Segmented transfers are not hashed while streaming
+                partial.md5 = file_md5(path).hexdigest()
+            if partial.md5 == expected:
+                return True
+            reason = "MD5 %s instead of %s" % (partial.md5, expected)
+            attempt += 1
+            if attempt > 1:
+                self.artifacts.reject(key, partial.url, path, reason)
+                return False
+            print("REFETCHING FILE: %s, %s" % (partial.url, reason))
+            os.remove(path)
+            partial.received = 0
+            partial.segments = None
+            partial.md5 = None
+            r = self.session.get(partial.url, stream=True)
+
+
+class GatherFiles(GatherDownload):
+    """
+    Selective download lane. Instead of the bundle, fetches the single files of an OID picked from its directory XML
+    by --include/--exclude into Downloads/<oid>/. Items are (oid, [(filename, url, size), ...]); files already present
+    with their listed size are not fetched again.
+    """
+
+    def __init__(self, ids, session, dest_dir, tmp_dir, segments, segment_threshold, transfers=None):
+        GatherDownload.__init__(self, ids, session, dest_dir, tmp_dir, False, None, segments, segment_threshold,
+                                transfers=transfers)
+
+    def workflow(self):
+        self.dest_dir = os.path.join(self.dest_dir, "Downloads")
+        if not self.tmp_dir:
+            self.tmp_dir = self.dest_dir
+
+        for oid, files_ in self.session.claim(self.ids):
+            oid_dir = os.path.join(self.dest_dir, oid)
+            if not os.path.exists(oid_dir):
+                os.makedirs(oid_dir)
+            for filename, url, size in files_:
+                path = os.path.join(oid_dir, filename)
+                if size and os.path.exists(path) and os.path.getsize(path) == size:
+                    continue
+                r, partial = self.fetch('%s/%s' % (PORTAL_URL, url), oid, filename)
+                if not self.is_payload(r):
+                    write_response(r, os.path.join(self.dest_dir, "ERROR_%s_%s.html" % (oid, filename)))
+                else:
+                    print("WRITING FILE: %s of %s" % (filename, oid))
+                    self.receive(r, partial, path)
+
+    def is_payload(self, r):
+        # Any file type is fine, except the HTML error page of the portal
+        return r.status_code in (200, 206) and not r.headers.get("Content-Type", "").startswith("text/html")
+
+
+class GatherVerify(WorkflowRunner):
+    """
+    Verification lane. Takes stored artifacts (raw or shrinked bundles) from the queue filled through the artifact
+    index and decompresses each once through tar, which checks the gzip CRC and the tar structure together. Intact
+    artifacts are committed to the manifest, corrupt ones rejected. The number of lanes bounds the CPU spent on it.
+    """
+
+    # Decompression per suffix, anything else is tested as plain tar
+    DECOMPRESS = {".gz": "gzip -dc", ".zst": "zstd -q -dc"}
+
+    def __init__(self, queue, artifacts, telemetry=None):
+        self.queue = queue
+        self.artifacts = artifacts
+        self.telemetry = telemetry
+
+    def workflow(self):
+        for key, url, path, md5 in self.queue:
+            start = time.time()
+            error = self.test_archive(path)
+            if self.telemetry:
+                self.telemetry.event("verify", oid=key, url=url, seconds=time.time() - start, intact=error is None,
+                                     bytes_in=os.path.getsize(path))
+            if error is None:
+                self.artifacts.commit(key, url, path, md5)
+            else:
+                self.artifacts.reject(key, url, path, error)
+
+    def test_archive(self, path):
+        """
+        Returns None if path is an intact (gzipped) tar, the error otherwise.
+        """
+        devnull = open(os.devnull, "w")
+        try:
+            decompress = self.DECOMPRESS.get(os.path.splitext(path)[1])
+            if not decompress:
+                tar_ = subprocess.Popen(["tar", "tf", path], stdout=devnull, stderr=subprocess.PIPE)
+                tar_err = tar_.communicate()[1]
+            else:
+                gzip_ = subprocess.Popen(shlex.split(decompress) + [path], stdout=subprocess.PIPE,
+                                         stderr=subprocess.PIPE)
+                tar_ = subprocess.Popen(["tar", "tf", "-"], stdin=gzip_.stdout, stdout=devnull,
+                                        stderr=subprocess.PIPE)
+                gzip_.stdout.close()
+                tar_err = tar_.communicate()[1]
+                gzip_err = gzip_.stderr.read()
+                if not gzip_.wait() == 0:
+                    return gzip_err.strip() or "%s failed" % (decompress)
+            if not tar_.returncode == 0:
+                return tar_err.strip() or "tar failed"
+            return None
+        finally:
+            devnull.close()
+
 
-    def post_process_tar(self, content, key, tmp_dir, dest_dir, unassembled, keep_unassembled, suffix):
+class GatherShrink(WorkflowRunner):
+    """
+    Shrinking lane. Takes downloaded bundles from the bounded hand-off queue filled by the download lanes and removes
+    fna, faa and gff (and unassembled) files from them. Runs in its own pool of lanes with its own CPU budget, so
+    recompressing never blocks a download connection and only a fixed number of codec processes run at once.
+    """
+
+    def __init__(self, queue, dest_dir, tmp_dir, unassembled, keep_unassembled, codec, artifacts=None,
+                 telemetry=None):
+        self.queue = queue
+        self.dest_dir = dest_dir
+        self.tmp_dir = tmp_dir
+        self.unassembled = unassembled
+        self.keep_unassembled = keep_unassembled
+        self.codec = codec
+        self.artifacts = artifacts
+        self.telemetry = telemetry
+
+    def workflow(self):
+        self.dest_dir = os.path.join(self.dest_dir, "Downloads")
+        if not self.tmp_dir:
+            self.tmp_dir = self.dest_dir
+
+        # Keep draining the queue if a bundle fails, download lanes would block on the full queue otherwise
+        failed = []
+        for pre_path, key, suffix, url in self.queue:
+            try:
+                start = time.time()
+                bytes_in = os.path.getsize(pre_path)
+                path = self.post_process_tar(pre_path, key, self.tmp_dir, self.dest_dir, self.unassembled,
+                                             self.keep_unassembled, suffix)
+                if self.telemetry:
+                    self.telemetry.event("shrink", oid=key, url=url, seconds=time.time() - start, bytes_in=bytes_in,
+                                         bytes_out=os.path.getsize(path) if path else 0, codec=self.codec.name,
+                                         level=self.codec.level, threads=self.codec.threads)
+                if path and self.artifacts:
+                    self.artifacts.store(key, url, path)
+            except Exception as e:
+                print("ERROR WITHIN %s: %s" % (key, e))
+                failed.append(key)
+        if failed:
+            raise RuntimeError("Shrinking failed for %s" % (", ".join(failed)))
+
+    def post_process_tar(self, pre_path, key, tmp_dir, dest_dir, unassembled, keep_unassembled, suffix):
+        """
+        Returns the path the bundle ended up at: shrinked, unshrinked if shrinking failed or None if it is unusable.
+        """
+        stored = None
 
         if suffix:
             suffix = "_%s" % (suffix)
 
-        outFile = open(os.path.join(tmp_dir, "pre_%s%s.tar.gz" % (key, suffix)), "w+b")
-        outFile.write(content)
-        outFile.seek(0)
+        outFile = open(pre_path, "rb")
 
-        outFinalFile = open(os.path.join(dest_dir, "shrinked", "%s%s.tar.gz" % (key, suffix)), "w")
+        outFinalFile = open(os.path.join(dest_dir, "shrinked", "%s%s%s" % (key, suffix, self.codec.suffix)), "w")
 
         file_type = subprocess.check_output(['file', os.path.abspath(outFile.name)])
         file_type = file_type.split(" ", 1)[1].strip()
@@ -274,10 +1907,11 @@ class GatherDownload(WorkflowRunner):
 
 
                 cmd_tar = shlex.split(cmd_tar_posix % (os.path.abspath(outFile.name)))
-                cmd_pigz_c = shlex.split("pigz -9 -p 24")
+                cmd_pigz_c = self.codec.args()
 
                 tar_ = subprocess.Popen(cmd_tar, stdout=subprocess.PIPE)
                 pigz_c = subprocess.check_call(cmd_pigz_c, stdin=tar_.stdout, stdout=outFinalFile)
+                stored = outFinalFile.name
 
                 print(pigz_c)
 
@@ -287,11 +1921,12 @@ class GatherDownload(WorkflowRunner):
 
                 cmd_pigz_d = shlex.split("pigz -d")
                 cmd_tar = shlex.split(cmd_tar_gzip)
-                cmd_pigz_c = shlex.split("pigz -9 -p 24")
+                cmd_pigz_c = self.codec.args()
 
                 pigz_d = subprocess.Popen(cmd_pigz_d, stdin=outFile, stdout=subprocess.PIPE)
                 tar_ = subprocess.Popen(cmd_tar, stdin=pigz_d.stdout, stdout=subprocess.PIPE)
                 pigz_c = subprocess.check_call(cmd_pigz_c, stdin=tar_.stdout, stdout=outFinalFile)
+                stored = outFinalFile.name
 
                 print(pigz_c)
 
@@ -305,20 +1940,26 @@ class GatherDownload(WorkflowRunner):
             outFile.close()
             cmd_except = shlex.split("rm %s" % (outFinalFile.name))
             subprocess.check_call(cmd_except)
-            cmd_except = shlex.split(
-                "mv %s %s" % (os.path.abspath(outFile.name), os.path.join(dest_dir, "%s_proj.tar.gz" % (key))))
+            stored = os.path.join(dest_dir, "%s_proj.tar.gz" % (key))
+            cmd_except = shlex.split("mv %s %s" % (os.path.abspath(outFile.name), stored))
             subprocess.check_call(cmd_except)
         finally:
-            cmd_cleanup = shlex.split("rm %s" % (outFile.name))
-            subprocess.check_call(cmd_cleanup)
+            # Already moved into place, if shrinking failed
+            if os.path.exists(outFile.name):
+                cmd_cleanup = shlex.split("rm %s" % (outFile.name))
+                subprocess.check_call(cmd_cleanup)
 
             outFile.close()
             outFinalFile.close()
 
+        return stored
+
 
 class GenomeportalWorkflow(WorkflowRunner):
     def __init__(self, oids, project_field, download_data, dest_dir, tmp_dir, login, pw, con_limit, xml_dir, omit,
-                 unassembled, keep_unassembled):
+                 unassembled, keep_unassembled, dynamic, segments, segment_threshold, pipelined, shrink_workers,
+                 shrink_threads, stream_filter, xml_cache, xml_cache_ttl, request_rate, max_request_rate, finished,
+                 include, exclude, catalog, catalog_workers, plan, telemetry, verify_workers, codec, level):
         self.oids = oids
         self.project_field = project_field
         self.download_data = download_data
@@ -331,6 +1972,151 @@ class GenomeportalWorkflow(WorkflowRunner):
         self.omit = omit
         self.unassembled = unassembled
         self.keep_unassembled = keep_unassembled
+        # Pipelined lanes share the feed queues anyway, the XML lanes are dispatched the same way
+        self.dynamic = dynamic or pipelined
+        self.segments = segments
+        self.segment_threshold = segment_threshold
+        self.pipelined = pipelined
+        self.shrink_workers = shrink_workers
+        self.shrink_threads = shrink_threads
+        self.stream_filter = stream_filter
+        self.xml_cache = xml_cache
+        self.xml_cache_ttl = xml_cache_ttl
+        self.request_rate = request_rate
+        self.max_request_rate = max_request_rate
+        self.finished = finished
+        self.include = include
+        self.exclude = exclude
+        # Single files instead of bundles, nothing to shrink then
+        self.select = bool(include or exclude)
+        self.catalog = catalog
+        self.catalog_workers = catalog_workers
+        # Only report what a download would move, implies download_data
+        self.plan = plan
+        self.telemetry = telemetry
+        self.verify_workers = verify_workers
+        self.codec = codec
+        self.level = level
+
+    def split_work(self, items, weight=None):
+        """
+        Splits items into one share per lane. Either statically striped or, with dynamic dispatch, a single queue
+        that is shared by all lanes. With a weight (e.g. bytes), items are handed out heaviest first and static
+        shares are balanced by weight instead of count (longest processing time first).
+        """
+        if weight:
+            items = sorted(items, key=weight, reverse=True)
+        if self.dynamic:
+            queue = LaneQueue(items)
+            queue.close()
+            return [queue] * self.con_limit
+        if not weight:
+            return [items[i::self.con_limit] for i in xrange(self.con_limit)]
+
+        shares, loads = self.balance(items, weight)
+        for i in xrange(self.con_limit):
+            print("Lane %i\t#IDs:%i\t#Bytes:%i" % (i, len(shares[i]), loads[i]))
+        return shares
+
+    def balance(self, items, weight):
+        """
+        Longest processing time first: hands the heaviest remaining item to the least loaded lane. Returns shares and
+        loads per lane. Dynamic dispatch of the heaviest first sorted queue ends up with the same loads.
+        """
+        shares = [[] for i in xrange(self.con_limit)]
+        loads = [(0, i) for i in xrange(self.con_limit)]
+        for item in sorted(items, key=weight, reverse=True):
+            load, i = heapq.heappop(loads)
+            shares[i].append(item)
+            heapq.heappush(loads, (load + weight(item), i))
+        return shares, [load for load, i in sorted(loads, key=lambda l: l[1])]
+
+    def bundle_weight(self, items):
+        """
+        Weight of (key, url, size) items, the size of a bundle shared by several OIDs is split among them as it is
+        fetched only once.
+        """
+        counts = {}
+        for key, url, size in items:
+            counts[url] = counts.get(url, 0) + 1
+        return lambda item: item[2] / counts[item[1]] if item[1] else item[2]
+
+    def oid_bundles(self, catalog):
+        xmls_oid = catalog.oids("oid")
+        urls_oid = []
+        for oid in [x[0] for x in self.oids if x[0] in xmls_oid]:
+            bundle = catalog.bundle(oid, "oid")
+            if bundle is not None:
+                urls_oid.append((oid,) + bundle)
+        return urls_oid
+
+    def project_bundles(self, catalog):
+        # Project descriptors of earlier runs stay in the XML dir, only the outstanding OIDs of this run count
+        oids = set(x[0] for x in self.oids)
+        urls = []
+        for oid in sorted(catalog.oids("proj") & oids):
+            bundle = catalog.bundle(oid, "proj")
+            if bundle is not None:
+                urls.append((oid,) + bundle)
+        return urls
+
+    def selected_files(self, catalog):
+        files_oid = []
+        for oid in [x[0] for x in self.oids]:
+            entries = catalog.files(oid, self.include, self.exclude, not self.project_field == -1)
+            if entries:
+                files_oid.append((oid, entries))
+            else:
+                print("No files matching the include/exclude patterns listed for %s" % (oid))
+        return files_oid
+
+    def report_plan(self, catalog, transfers):
+        """
+        Prints what downloading the cart would move without transferring anything: bytes per lane, wall time projected
+        from the lane throughput measured in earlier runs, the tmp space needed at peak and the OIDs without bundle.
+        """
+        if self.select:
+            files_oid = self.selected_files(catalog)
+            stages = [("DLF", [(oid, "", sum(f_[2] for f_ in files_)) for oid, files_ in files_oid])]
+        else:
+            stages = [("DLX", self.oid_bundles(catalog))]
+            if not self.project_field == -1:
+                stages.append(("DLP", self.project_bundles(catalog)))
+
+        rate = transfers.throughput()
+        total_bytes = 0
+        total_seconds = 0
+        found = set()
+        print("PLAN\tconnection limit %i" % (self.con_limit))
+        for stage, items in stages:
+            if not items:
+                continue
+            found.update(item[0] for item in items if item[1] or self.select)
+            unique = dict((item[1] or item[0], item[2]) for item in items if item[1] or self.select)
+            unknown = len([size for size in unique.values() if not size])
+            shares, loads = self.balance(items, self.bundle_weight(items))
+            for i in xrange(self.con_limit):
+                print("PLAN\t%s%i\t#IDs:%i\t#Bytes:%i" % (stage, i, len(shares[i]), loads[i]))
+            print("PLAN\t%s\t#Unique:%i\t#Bytes:%i\t#UnknownSize:%i" % (stage, len(unique), sum(unique.values()),
+                                                                         unknown))
+            total_bytes += sum(unique.values())
+            if rate:
+                # Stages run one after the other, each takes as long as its most loaded lane
+                total_seconds += max(loads) / rate
+
+            if not self.select and self.omit and not self.stream_filter:
+                # Bundles of all busy download lanes plus the ones waiting in the shrink queue
+                peak = sum(sorted(unique.values(), reverse=True)[:self.con_limit + self.shrink_workers])
+                print("PLAN\t%s\tpeak tmp space about %.1f GB" % (stage, peak / 1024.0 ** 3))
+
+        print("PLAN\ttotal %.1f GB" % (total_bytes / 1024.0 ** 3))
+        if rate:
+            print("PLAN\tprojected wall time %.2f h at %.1f MB/s per lane (earlier runs)" % (
+                total_seconds / 3600.0, rate / 1024.0 ** 2))
+        else:
+            print("PLAN\tno throughput measured in earlier runs, wall time not projected")
+        missing = [x[0] for x in self.oids if x[0] not in found]
+        print("PLAN\t%i OIDs without bundle%s" % (len(missing), ": " + ", ".join(missing) if missing else ""))
 
     def workflow(self):
 
@@ -377,8 +2163,8 @@ class GenomeportalWorkflow(WorkflowRunner):
             self.addTask(label="makeDLDirectoryShrinked", isForceLocal=True)
 
         os.popen(
-            "curl 'https://signon.jgi.doe.gov/signon/create' --data-urlencode 'login=%s' --data-urlencode 'password=%s' -c cookies > /dev/null" % (
-                self.login, self.pw))
+            "curl '%s' --data-urlencode 'login=%s' --data-urlencode 'password=%s' -c cookies > /dev/null" % (
+                SIGNON_URL, self.login, self.pw))
         # cmd = "curl 'https://signon.jgi.doe.gov/signon/create' --data-urlencode 'login=%s' --data-urlencode 'password=%s' -c cookies > /dev/null" % (self.login, self.pw)
         # self.addTask(label="createCookie", command=cmd, isForceLocal=True)
 
@@ -394,70 +2180,149 @@ class GenomeportalWorkflow(WorkflowRunner):
                 break
         inFile.close()
 
+        rate = RateController(self.request_rate, self.max_request_rate, self.con_limit)
+        telemetry = None
+        if self.telemetry:
+            telemetry = Telemetry(self.telemetry)
+        session = JGISession(cookies, self.con_limit, rate, telemetry)
+
+        # Skip everything finished before, by --finished or according to the manifest of earlier runs
+        manifest = Manifest(os.path.join(self.dest_dir, "Downloads", "manifest.tsv"))
+        verify_queue = None
+        verify_tasks = []
+        if self.verify_workers and self.download_data and not self.select and not self.plan:
+            verify_queue = LaneQueue()
+        artifacts = ArtifactIndex(manifest, verify_queue)
+        for i in xrange(self.verify_workers if verify_queue else 0):
+            taskId = "VRF%i" % (i)
+            verify_tasks.append(taskId)
+            self.addWorkflowTask(taskId, GatherVerify(verify_queue, artifacts, telemetry),
+                                 dependencies=["makeDLDirectory", "makeDLDirectoryShrinked"])
+        transfers = TransferLog(os.path.join(self.dest_dir, "Downloads", "transfers.tsv"))
+        done = set(self.finished)
+        for oid, entry in manifest.read().iteritems():
+            if os.path.exists(entry[4]):
+                done.add(oid)
+        oids = [x for x in self.oids if x[0] not in done]
+        print("Skipping %i finished OIDs, %i left" % (len(self.oids) - len(oids), len(oids)))
+        self.oids = oids
+
+        xml_dir = ""
+
+        if not self.xml_dir:
+            xml_dir = os.path.join(self.dest_dir, "XML")
+        else:
+            xml_dir = self.xml_dir
+
+        feed = None
+        if self.pipelined and self.download_data and not self.select and not self.plan:
+            feed = XMLFeed(xml_dir)
+
+        cache = None
+        if self.xml_cache:
+            cache = XMLCache(self.xml_cache, self.xml_cache_ttl * 3600)
+
         tasklist = []
         if not self.xml_dir:
+            shares = self.split_work(self.oids)
             for i in xrange(self.con_limit):
                 taskId = "XML%i" % (i)
                 tasklist.append(taskId)
-                cur_ids = self.oids[i::self.con_limit]
+                cur_ids = shares[i]
                 print("Task:%s\t#IDs:%i" % (taskId, len(cur_ids)))
-                wflow = GatherXMLWorkflow(cur_ids, self.project_field, self.dest_dir, cookies)
+                wflow = GatherXMLWorkflow(cur_ids, self.project_field, self.dest_dir, session, feed, cache)
                 self.addWorkflowTask(taskId, wflow,
                                      dependencies=["makeXMLDirectory", "makeDLDirectory", "makeTMPDirectory",
                                                    "makeDLDirectoryShrinked"])
 
-        xml_dir = ""
-
-        if not self.xml_dir:
-            xml_dir = os.path.join(self.dest_dir, "XML")
-        else:
-            xml_dir = self.xml_dir
+        shrink_queue = None
+        shrink_tasks = []
+        tar_filter = None
+        # Share the cores among the bundles recompressed at once, one per download lane when streaming
+        threads = self.shrink_threads
+        if not threads:
+            threads = max(1, multiprocessing.cpu_count() // (self.con_limit if self.stream_filter else
+                                                             self.shrink_workers))
+        codec = Codec(self.codec, self.level, threads)
+        if self.omit and self.download_data and not self.select and self.stream_filter:
+            tar_filter = TarFilter(self.tmp_dir, self.unassembled, self.keep_unassembled, codec)
+        elif self.omit and self.download_data and not self.select and not self.plan:
+            # Bounded, so downloads pause instead of piling up raw bundles in the tmp dir while shrinking lags behind
+            shrink_queue = LaneQueue(maxsize=self.shrink_workers)
+            for i in xrange(self.shrink_workers):
+                taskId = "SHR%i" % (i)
+                shrink_tasks.append(taskId)
+                wflow = GatherShrink(shrink_queue, self.dest_dir, self.tmp_dir, self.unassembled,
+                                     self.keep_unassembled, codec, artifacts, telemetry)
+                self.addWorkflowTask(taskId, wflow, dependencies=["makeDLDirectoryShrinked", "makeTMPDirectory"])
+
+        space = None
+        if shrink_queue:
+            # Only bundles waiting for the shrinking lanes are written to the tmp dir
+            space = TmpSpace(self.tmp_dir or os.path.join(self.dest_dir, "Downloads"))
 
         tasklist2 = []
-        self.waitForTasks(tasklist)
-        if self.download_data:
-            xmls = os.listdir(xml_dir)
-            xmls = filter(lambda x: x.endswith(".xml"), xmls)
-            xmls_oid = filter(lambda x: not x.startswith("proj"), xmls)
-            xmls_oid = [x.split(".")[0] for x in xmls_oid]
+        if feed:
+            # Download lanes start right away and consume the queues while the XML lanes still fill them
+            dl_dependencies = ["makeDLDirectory", "makeTMPDirectory", "makeDLDirectoryShrinked"]
+            for i in xrange(self.con_limit):
+                taskId = "DLX%i" % (i)
+                tasklist2.append(taskId)
+                wflow = GatherDownload(feed.oid_queue, session, self.dest_dir, self.tmp_dir, False,
+                                       shrink_queue, self.segments, self.segment_threshold, tar_filter, space,
+                                       artifacts, transfers)
+                self.addWorkflowTask(taskId, wflow, dependencies=dl_dependencies)
 
-            tasks_oids = []
-            xmls_oid = [x[0] for x in self.oids if x[0] in xmls_oid]
+            if not self.project_field == -1:
+                for i in xrange(self.con_limit):
+                    taskId = "DLP%i" % (i)
+                    tasklist2.append(taskId)
+                    wflow = GatherDownload(feed.proj_queue, session, self.dest_dir, self.tmp_dir, False,
+                                           shrink_queue, self.segments, self.segment_threshold, tar_filter, space,
+                                           artifacts, transfers)
+                    self.addWorkflowTask(taskId, wflow, dependencies=dl_dependencies)
 
-            urls_oid = {}
+        try:
+            # With -x there are no XML lanes, the catalog still needs the base directory to exist
+            self.waitForTasks(tasklist + ["makeBaseDirectory"])
+        finally:
+            # Close the queues even if XML lanes failed, the download lanes would wait forever otherwise
+            if feed:
+                feed.close(self.oids)
 
-            for oid in xmls_oid:
-                if magic.from_file(os.path.join(xml_dir, "%s.xml" % (oid)), mime=True) == "application/xml":
-                    print("Parsing file %s.xml" % (oid))
-                    root = etree.parse(os.path.join(xml_dir, "%s.xml" % (oid)))
-                    files_ = root.findall(".//file[@url]")
-                    url = []
-                    bundle = ""
-                    for f_ in files_:
-                        if f_.attrib["filename"] == "download_bundle.tar.gz":
-                            bundle = f_.attrib["url"]
-                    if bundle:
-                        url.append(bundle)
-                    else:
-                        for f_ in files_:
-                            if f_.attrib["filename"] == "%s.tar.gz" % (oid):
-                                url.append(f_.attrib["url"])
-                    if not len(url) == 0:
-                        urls_oid[oid] = url[0]
-                    else:
-                        print("XML description, but no alternative .tar.gz available for %s" % (oid))
-                        urls_oid[oid] = ""
+        catalog = None
+        if self.download_data and not feed:
+            # Parse all descriptions once and in parallel, planning only queries the catalog
+            catalog = Catalog(self.catalog or os.path.join(self.dest_dir, "catalog.sqlite"))
+            catalog.update(xml_dir, self.catalog_workers, dict(x[:2] for x in self.oids if len(x) > 1))
+            artifacts.checksums = catalog.checksums(PORTAL_URL)
+
+        if self.plan:
+            self.report_plan(catalog, transfers)
+
+        elif self.download_data and self.select:
+            files_oid = self.selected_files(catalog)
+
+            shares = self.split_work(files_oid, weight=lambda item: sum(f_[2] for f_ in item[1]))
+            for i in xrange(self.con_limit):
+                taskId = "DLF%i" % (i)
+                tasklist2.append(taskId)
+                wflow = GatherFiles(shares[i], session, self.dest_dir, self.tmp_dir, self.segments,
+                                    self.segment_threshold, transfers)
+                self.addWorkflowTask(taskId, wflow, dependencies=tasklist)
+
+        elif self.download_data and not feed:
+            tasks_oids = []
+            urls_oid = self.oid_bundles(catalog)
 
-            urls_keys = urls_oid.keys()
+            shares = self.split_work(urls_oid, weight=self.bundle_weight(urls_oid))
             for i in xrange(self.con_limit):
-                urls_keys_ = urls_keys[i::self.con_limit]
-                urls_ = {}
-                for key in urls_keys_:
-                    urls_[key] = urls_oid[key]
+                urls_ = shares[i]
                 taskId = "DLX%i" % (i)
                 tasks_oids.append(taskId)
-                wflow = GatherDownload(urls_, cookies, self.dest_dir, self.tmp_dir, False, self.omit,
-                                       self.unassembled, self.keep_unassembled)
+                wflow = GatherDownload(urls_, session, self.dest_dir, self.tmp_dir, False,
+                                       shrink_queue, self.segments, self.segment_threshold, tar_filter, space,
+                                       artifacts, transfers)
                 self.addWorkflowTask(taskId, wflow, dependencies=tasklist)
 
             # for i in xrange(self.con_limit):
@@ -470,56 +2335,55 @@ class GenomeportalWorkflow(WorkflowRunner):
             tasklist2.extend(tasks_oids)
 
             if not self.project_field == -1:
-                xmls_proj = filter(lambda x: x.startswith("proj"), xmls)
-
-                urls = {}
-
-                for xml_path in xmls_proj:
-                    if magic.from_file(os.path.join(xml_dir, xml_path), mime=True) == "application/xml":
-                        print("Parsing file %s" % (xml_path))
-                        root = etree.parse(os.path.join(xml_dir, xml_path))
-                        files_ = root.findall(".//file[@url]")
-                        url = []
-                        xml_path = xml_path.split(".")[0].split("_")[1]
-                        for f_ in files_:
-                            if f_.attrib["filename"] == "%s.tar.gz" % (xml_path):
-                                url.append(f_.attrib["url"])
-                        if not len(url) == 0:
-                            urls[xml_path] = url[0]
-                        else:
-                            print("XML description, but no alternative .tar.gz available for %s" % (xml_path))
-                            urls[xml_path] = ""
+                urls = self.project_bundles(catalog)
 
-                urls_keys = urls.keys()
+                shares = self.split_work(urls, weight=self.bundle_weight(urls))
                 for i in xrange(self.con_limit):
-                    urls_keys_ = urls_keys[i::self.con_limit]
-                    urls_ = {}
-                    for key in urls_keys_:
-                        urls_[key] = urls[key]
+                    urls_ = shares[i]
                     taskId = "DLP%i" % (i)
                     tasklist2.append(taskId)
-                    wflow = GatherDownload(urls_, cookies, self.dest_dir, self.tmp_dir, False, self.omit,
-                                           self.unassembled, self.keep_unassembled)
+                    wflow = GatherDownload(urls_, session, self.dest_dir, self.tmp_dir, False,
+                                           shrink_queue, self.segments, self.segment_threshold, tar_filter, space,
+                                           artifacts, transfers)
                     self.addWorkflowTask(taskId, wflow, dependencies=tasks_oids)
 
+        if shrink_queue:
+            try:
+                self.waitForTasks(tasklist2)
+            finally:
+                shrink_queue.close()
 
-                    ###
-                    # NO CHECK AT ALL -> Will come in future release
-                    # xmls_proj = [x.split(".")[0] for x in xmls_proj]
-                    # xmls_proj = [x.split("_")[1] for x in xmls_proj]
-                    # xmls_proj = [x for x in xmls_proj if x in self.oids]
-                    #####
+        if verify_queue:
+            try:
+                self.waitForTasks(tasklist2 + shrink_tasks)
+            finally:
+                verify_queue.close()
 
         cmd = "rm cookies"
-        self.addTask(label="removeCookie", command=cmd, isForceLocal=True, dependencies=tasklist2)
+        self.addTask(label="removeCookie", command=cmd, isForceLocal=True,
+                     dependencies=tasklist2 + shrink_tasks + verify_tasks)
         if self.tmp_dir:
             cmd = "rm -rf %s" % (self.tmp_dir)
             self.addTask(label="removeTMPDir", command=cmd, isForceLocal=True, dependencies="removeCookie")
 
 
 def main():
+    global PORTAL_URL, IMG_URL, SIGNON_URL
+
     args = parse_arguments()
 
+    # Lane counts, a pool of zero lanes would never drain its queue
+    for option, value in (("--connection-limit", args.con_limit), ("--shrink-workers", args.shrink_workers),
+                          ("--catalog-workers", args.catalog_workers)):
+        if value < 1:
+            sys.exit("%s must be at least 1." % (option))
+    if args.verify_workers < 0:
+        sys.exit("--verify-workers must be at least 0.")
+
+    if args.portal_url:
+        PORTAL_URL = IMG_URL = args.portal_url.rstrip("/")
+        SIGNON_URL = "%s/signon/create" % (PORTAL_URL)
+
     ids = []
 
     # Export IMG taxonOIDs
@@ -538,6 +2402,18 @@ def main():
             ids.append([line.strip().split('\t')[0]])
     inFile.close()
 
+    finished = set()
+    if args.finished:
+        inFile = open(args.finished)
+        if args.skip_header:
+            inFile.readline()
+        for line in inFile:
+            finished.add(line.strip().split('\t')[0])
+        inFile.close()
+
+    include = args.include.split(",") if args.include else []
+    exclude = args.exclude.split(",") if args.exclude else []
+
     login = ""
     pw = ""
 
@@ -549,10 +2425,17 @@ def main():
         pw = inFile.readline().strip()
         inFile.close()
 
-    wflow = GenomeportalWorkflow(ids, args.project_field, args.download, args.dest_dir, args.tmp_dir, login, pw,
-                                 args.con_limit, args.xml_dir, args.nofaafnagff, args.unassembled,
-                                 args.keep_unassembled)
-    retval = wflow.run(mode="sge", nCores="unlimited", memMb="unlimited", isDryRun=args.dry_run)
+    wflow = GenomeportalWorkflow(ids, args.project_field, args.download or args.plan, args.dest_dir, args.tmp_dir,
+                                 login, pw, args.con_limit, args.xml_dir, args.nofaafnagff, args.unassembled,
+                                 args.keep_unassembled, args.dynamic, args.segments, args.segment_threshold,
+                                 args.pipelined, args.shrink_workers, args.shrink_threads, args.stream_filter,
+                                 args.xml_cache, args.xml_cache_ttl, args.request_rate, args.max_request_rate,
+                                 finished, include, exclude, args.catalog, args.catalog_workers,
+                                 args.plan, args.telemetry, args.verify_workers, args.codec, args.level)
+    retval = wflow.run(mode="sge", nCores="unlimited", memMb="unlimited", isDryRun=args.dry_run,
+                       isContinue=args.continued)
+    if args.telemetry and os.path.exists(args.telemetry):
+        summarize_telemetry(args.telemetry, args.dest_dir)
     sys.exit(retval)
 
 
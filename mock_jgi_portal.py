@@ -0,0 +1,417 @@
+#!/usr/bin/env python2.7
+# coding=utf-8
+
+"""
+	Date:   18/10/2026
+	Usage:  For usage instructions run with option --help
+	Author: Madis Rumming <mrumming@cebitec.uni-bielefeld.de>
+"""
+
+__author__  = "Madis Rumming <mrumming@cebitec.uni-bielefeld.de>"
+__copyright__ = "Copyright 2016, Computational Metagenomics, Faculty of Technology, Bielefeld University"
+
+__version__ = "1.2.a"
+__maintainer__ = "Madis Rumming"
+__email__ = "mrumming@cebitec.uni-bielefeld.de"
+__status__ = "Production"
+
+
+
+
+import argparse
+import BaseHTTPServer
+import SocketServer
+import urlparse
+import os.path
+import sys
+import errno
+import hashlib
+import random
+import shutil
+import string
+import tarfile
+import tempfile
+import threading
+import time
+
+# Local stand-in for the JGI genome portal, IMG and the JGI SSO, serving synthetic bundles. Run
+# genomeportal_pyflow.py with --portal-url http://127.0.0.1:<port> against it.
+#
+#   POST /signon/create                                     session cookie
+#   GET  /ext-api/downloads/get-directory?organism=IMG_<oid> directory XML of an OID (HTML error page if missing)
+#   GET  /ext-api/downloads/get-directory?organism=Proj<id> directory XML of a project listing <oid>.tar.gz
+#   GET  /lookup?keyName=jgiProjectId&keyValue=<id>          redirect to the organism name of a project
+#   GET  /cgi-bin/m/main.cgi?section=TaxonDetail&...         taxon page linking the project lookup of an OID
+#   GET  /IMG_<oid>/download/...  /Proj<id>/download/...     bundles and single files, with Range support
+
+# Uncompressed share of every member of the default layout in a bundle
+LAYOUT = "a.fna:30,a.faa:20,a.gff:10,a.cog.txt:5,a.ko.txt:5,u.fna:15,u.faa:8,u.gff:5,README.txt:2"
+
+# Alphabets of the synthetic member contents, sequences compress about as well as real ones
+NUCLEOTIDES = string.maketrans("".join(chr(i) for i in xrange(256)), "ACGT" * 64)
+AMINO_ACIDS = string.maketrans("".join(chr(i) for i in xrange(256)), ("ACDEFGHIKLMNPQRSTVWY" * 13)[:256])
+TABLE = string.maketrans("".join(chr(i) for i in xrange(256)), ("0123456789\t" * 24)[:256])
+
+# Bytes written per block when generating members and serving files
+BLOCK_SIZE = 1024 * 1024
+
+
+def project_of(oid):
+    """
+    Project id of an OID on the mock portal, use it for the project column of a genome cart.
+    """
+    return "9%s" % (oid)
+
+
+def oid_of(project):
+    return project[1:]
+
+
+def ratio(key, salt):
+    """
+    Deterministic pseudo random number in [0, 1) for key, so every restart of the portal serves the same data.
+    """
+    return int(hashlib.md5("%s:%s" % (salt, key)).hexdigest()[:8], 16) / float(16 ** 8)
+
+
+class MockPortal(object):
+    """
+    Synthetic portal data and fault injection. Bundles are generated on first request and kept in the data dir:
+    Members of the layout sized by their share of the bundle size (spread per OID), with sequence-like content.
+    """
+
+    def __init__(self, data_dir, bundle_size, layout, spread, missing, latency, throttle, drop):
+        self.data_dir = data_dir
+        self.bundle_size = int(bundle_size * 1024 * 1024)
+        self.layout = [(member.split(":")[0], float(member.split(":")[1])) for member in layout.split(",")]
+        self.spread = spread
+        self.missing = missing
+        self.latency = latency
+        self.throttle = throttle
+        self.drop = drop
+        self.lock = threading.Lock()
+        self.generating = {}
+
+        try:
+            os.makedirs(data_dir)
+        except OSError as e:
+            if not e.errno == errno.EEXIST:
+                raise
+
+    def is_missing(self, oid):
+        """
+        OIDs without directory of their own, they are only available through their project.
+        """
+        return ratio(oid, "missing") < self.missing
+
+    def oid_dir(self, oid):
+        return os.path.join(self.data_dir, oid)
+
+    def member_path(self, oid, member):
+        return os.path.join(self.oid_dir(oid), "%s.%s" % (oid, member))
+
+    def bundle_path(self, oid):
+        """
+        Returns the path of the bundle of an OID, generating it first if needed. Concurrent requests for the same
+        bundle wait for a single generation.
+        """
+        path = os.path.join(self.data_dir, "%s.tar.gz" % (oid))
+        with self.lock:
+            if os.path.exists(path):
+                return path
+            event = self.generating.get(oid)
+            owner = event is None
+            if owner:
+                event = self.generating[oid] = threading.Event()
+        if not owner:
+            event.wait()
+            return path
+
+        try:
+            self.generate(oid, path)
+        finally:
+            with self.lock:
+                del self.generating[oid]
+            event.set()
+        return path
+
+    def generate(self, oid, path):
+        size = self.bundle_size * (1 - self.spread + 2 * self.spread * ratio(oid, "size"))
+        total = sum(share for member, share in self.layout)
+        if not os.path.exists(self.oid_dir(oid)):
+            os.makedirs(self.oid_dir(oid))
+
+        tmp_path = path + ".tmp"
+        tar = tarfile.open(tmp_path, "w:gz")
+        for member, share in self.layout:
+            member_path = self.member_path(oid, member)
+            if member.endswith(".fna"):
+                table = NUCLEOTIDES
+            elif member.endswith(".faa"):
+                table = AMINO_ACIDS
+            else:
+                table = TABLE
+            remaining = int(size * share / total)
+            outFile = open(member_path, "wb")
+            while remaining > 0:
+                block = os.urandom(min(BLOCK_SIZE, remaining)).translate(table)
+                # Line breaks every 80 characters, as in FASTA files
+                outFile.write("\n".join(block[i:i + 80] for i in xrange(0, len(block), 80)) + "\n")
+                remaining -= len(block)
+            outFile.close()
+            tar.add(member_path, arcname="%s/%s.%s" % (oid, oid, member))
+        tar.close()
+        os.rename(tmp_path, path)
+
+    def file_entry(self, path, filename, url):
+        size = os.path.getsize(path)
+        md5 = hashlib.md5()
+        inFile = open(path, "rb")
+        for block in iter(lambda: inFile.read(BLOCK_SIZE), ""):
+            md5.update(block)
+        inFile.close()
+        timestamp = time.strftime("%a %b %d %H:%M:%S %Z %Y", time.localtime(os.path.getmtime(path)))
+        return '    <file label="%s" filename="%s" size="%i MB" sizeInBytes="%i" timestamp="%s" url="%s" md5="%s"/>' % (
+            filename, filename, size / (1024 * 1024), size, timestamp, url, md5.hexdigest())
+
+    def oid_directory(self, oid):
+        bundle = self.bundle_path(oid)
+        entries = [self.file_entry(bundle, "download_bundle.tar.gz", "/IMG_%s/download/download_bundle.tar.gz" % (oid))]
+        for member, share in self.layout:
+            filename = "%s.%s" % (oid, member)
+            entries.append(self.file_entry(self.member_path(oid, member), filename,
+                                           "/IMG_%s/download/%s" % (oid, filename)))
+        return self.directory("IMG_%s" % (oid), entries)
+
+    def project_directory(self, project):
+        oid = oid_of(project)
+        entries = [self.file_entry(self.bundle_path(oid), "%s.tar.gz" % (oid),
+                                   "/Proj%s/download/%s.tar.gz" % (project, oid))]
+        return self.directory("Proj%s" % (project), entries)
+
+    def directory(self, name, entries):
+        return "\n".join(['<?xml version="1.0" encoding="UTF-8"?>', '<organismDownloads name="%s">' % (name),
+                          '  <folder name="IMG Data">'] + entries + ['  </folder>', '</organismDownloads>', ''])
+
+    def file_path(self, path):
+        """
+        Maps the path of a download URL to the file it serves, None if there is none.
+        """
+        parts = path.strip("/").split("/")
+        if not len(parts) == 3 or not parts[1] == "download":
+            return None
+        if parts[0].startswith("IMG_"):
+            oid = parts[0][len("IMG_"):]
+            if self.is_missing(oid):
+                return None
+            if parts[2] == "download_bundle.tar.gz":
+                return self.bundle_path(oid)
+            self.bundle_path(oid)
+            path = os.path.join(self.oid_dir(oid), parts[2])
+        elif parts[0].startswith("Proj"):
+            oid = oid_of(parts[0][len("Proj"):])
+            if not parts[2] == "%s.tar.gz" % (oid):
+                return None
+            path = self.bundle_path(oid)
+        else:
+            return None
+        if os.path.exists(path):
+            return path
+        return None
+
+
+class MockHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    # Keep-alive, the downloader reuses its connections
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, format, *args)
+
+    def base_url(self):
+        return "http://%s" % (self.headers.get("Host", "%s:%i" % self.server.server_address))
+
+    def respond(self, status, body, content_type="text/html", headers=()):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for header in headers:
+            self.send_header(*header)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def error_page(self):
+        self.respond(200, "<html><body><h1>Error</h1><p>No data available.</p></body></html>")
+
+    def is_throttled(self):
+        portal = self.server.portal
+        if portal.latency:
+            time.sleep(portal.latency)
+        if random.random() < portal.throttle:
+            self.respond(429, "<html><body>Too many requests</body></html>", headers=[("Retry-After", "1")])
+            return True
+        return False
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        self.rfile.read(length)
+        if self.is_throttled():
+            return
+        if urlparse.urlparse(self.path).path == "/signon/create":
+            self.respond(200, "<html><body>Signed on</body></html>",
+                         headers=[("Set-Cookie", "jgi_session=mock; Path=/")])
+        else:
+            self.respond(404, "<html><body>Not found</body></html>")
+
+    def do_GET(self):
+        if self.is_throttled():
+            return
+        portal = self.server.portal
+        url = urlparse.urlparse(self.path)
+        query = dict(urlparse.parse_qsl(url.query))
+
+        if url.path == "/ext-api/downloads/get-directory":
+            organism = query.get("organism", "")
+            if organism.startswith("IMG_") and not portal.is_missing(organism[len("IMG_"):]):
+                self.respond(200, portal.oid_directory(organism[len("IMG_"):]), "application/xml")
+            elif organism.startswith("Proj"):
+                self.respond(200, portal.project_directory(organism[len("Proj"):]), "application/xml")
+            else:
+                self.error_page()
+        elif url.path == "/lookup":
+            location = "%s/lookup-result?organism=Proj%s" % (self.base_url(), query.get("keyValue", ""))
+            self.respond(302, "", headers=[("Location", location)])
+        elif url.path == "/lookup-result":
+            self.respond(200, "<html><body>%s</body></html>" % (query.get("organism", "")))
+        elif url.path == "/cgi-bin/m/main.cgi":
+            oid = query.get("taxon_oid", "")
+            self.respond(200, '<html><body><a href="%s/lookup?keyName=jgiProjectId&keyValue=%s">Project</a>'
+                              '</body></html>' % (self.base_url(), project_of(oid)))
+        else:
+            path = portal.file_path(url.path)
+            if path is None:
+                self.error_page()
+            else:
+                self.send_file(path)
+
+    def send_file(self, path):
+        """
+        Serves a file, honouring a Range header of the forms bytes=<first>- and bytes=<first>-<last>. With drop set,
+        the connection is cut at a random offset instead of sending the whole body.
+        """
+        size = os.path.getsize(path)
+        first, last = 0, size - 1
+        status = 200
+        range_ = self.headers.get("Range", "")
+        if range_.startswith("bytes="):
+            first, _, last_ = range_[len("bytes="):].partition("-")
+            first = int(first)
+            last = min(int(last_), size - 1) if last_ else size - 1
+            if first >= size:
+                self.respond(416, "", headers=[("Content-Range", "bytes */%i" % (size))])
+                return
+            status = 206
+
+        self.send_response(status)
+        self.send_header("Content-Type", "application/x-gzip" if path.endswith(".tar.gz") else "text/plain")
+        self.send_header("Content-Length", str(last - first + 1))
+        self.send_header("Accept-Ranges", "bytes")
+        if status == 206:
+            self.send_header("Content-Range", "bytes %i-%i/%i" % (first, last, size))
+        self.end_headers()
+
+        cut = None
+        if random.random() < self.server.portal.drop:
+            cut = first + int(random.random() * (last - first + 1))
+        inFile = open(path, "rb")
+        try:
+            inFile.seek(first)
+            position = first
+            while position <= last:
+                block = inFile.read(min(BLOCK_SIZE, last - position + 1))
+                if cut is not None and position + len(block) > cut:
+                    self.wfile.write(block[:cut - position])
+                    self.close_connection = 1
+                    return
+                self.wfile.write(block)
+                position += len(block)
+        finally:
+            inFile.close()
+
+
+class MockServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, portal, verbose=False):
+        BaseHTTPServer.HTTPServer.__init__(self, address, MockHandler)
+        self.portal = portal
+        self.verbose = verbose
+
+
+def start(portal, port=0, verbose=False):
+    """
+    Runs the mock portal in a background thread. Returns the server and its base URL.
+    """
+    server = MockServer(("127.0.0.1", port), portal, verbose)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server, "http://127.0.0.1:%i" % (server.server_address[1])
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser("Local mock of the JGI genome portal serving synthetic bundles.")
+    parser.add_argument("--port", dest='port', help="Port to listen on. Default: %i" % (8080), type=int, default=8080,
+                        required=False)
+    parser.add_argument("--data-dir", dest='data_dir',
+                        help="Directory generated bundles are kept in. Default: a new tmp dir, removed at exit",
+                        default=None, required=False)
+    parser.add_argument("--bundle-size", dest='bundle_size',
+                        help="Mean uncompressed bundle size in MB. Default: %i" % (64), type=float, default=64,
+                        required=False)
+    parser.add_argument("--layout", dest='layout',
+                        help="Comma separated bundle members <suffix>:<share>. Default: %s" % (LAYOUT),
+                        default=LAYOUT, required=False)
+    parser.add_argument("--size-spread", dest='spread',
+                        help="Bundle sizes vary by this fraction around the mean. Default: %.1f" % (0.5), type=float,
+                        default=0.5, required=False)
+    parser.add_argument("--missing", dest='missing',
+                        help="Fraction of OIDs without directory of their own, only available through their project. Default: %.1f" % (0.1),
+                        type=float, default=0.1, required=False)
+    parser.add_argument("--latency", dest='latency', help="Seconds added to every request. Default: %.1f" % (0),
+                        type=float, default=0, required=False)
+    parser.add_argument("--throttle", dest='throttle',
+                        help="Fraction of requests answered with 429 and Retry-After. Default: %.1f" % (0), type=float,
+                        default=0, required=False)
+    parser.add_argument("--drop", dest='drop',
+                        help="Fraction of file transfers cut off at a random byte. Default: %.1f" % (0), type=float,
+                        default=0, required=False)
+    parser.add_argument("-v", "--verbose", dest='verbose', help="Log every request.", default=False,
+                        action='store_true', required=False)
+
+    args = parser.parse_args()
+
+    return (args)
+
+
+def main():
+    args = parse_arguments()
+
+    data_dir = args.data_dir or tempfile.mkdtemp(prefix="mock_jgi_")
+    portal = MockPortal(data_dir, args.bundle_size, args.layout, args.spread, args.missing, args.latency,
+                        args.throttle, args.drop)
+    server = MockServer(("127.0.0.1", args.port), portal, args.verbose)
+    print("Serving mock JGI portal on http://127.0.0.1:%i from %s" % (server.server_address[1], data_dir))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if not args.data_dir:
+            shutil.rmtree(data_dir)
+
+
+if __name__ == "__main__":
+    main()